@@ -60,6 +60,15 @@ class TasksConfig(ConfigSchema, prefix="tasks"):
     #: If True, then do not actually execute tasks
     dry_run: bool = False
 
+    #: Where setup task completion stamps are kept: ``files`` for a ``.stamp-`` file per task in the object's *stamp_path*, or ``kvstore`` to keep them in the :class:`~carthage.kvstore.KvStore` (see :class:`~carthage.setup_tasks.KvStamps`)
+    stamp_backend: str = "files"
+
+    #: How many setup tasks of one object may run at once.  If greater than one, tasks run as soon as the tasks they require (see :func:`~carthage.setup_tasks.setup_task`) are done.
+    concurrency: int = 1
+
+    #: How many task executions ``task_history.jsonl`` in the state directory keeps; see :class:`~carthage.task_history.TaskHistory`
+    history_size: int = 10000
+
 
 class DebianConfig(ConfigSchema, prefix="debian"):
     mirror: ConfigString = "http://deb.debian.org/debian"
@@ -90,6 +90,7 @@ class Injectable:
     '''
     def __init_subclass__(cls, **kwargs):
         super().__init_subclass__(**kwargs)
+        _supplementary_keys_cache.clear()
         # Call inject to deal better with multiple inheritance and dependencies
         try: inject()(cls)
         except NameError:
@@ -131,17 +132,19 @@ class Injectable:
         '''
         Returns  an iteration of :class:`InjectionKeys <InjectionKey>` that should be added  to an injector when this class is added.  The current injection key is taken as an argument so that constraints applied can modify what keys are added.
 
+        The result of this implementation depends only on the class and the target and constraints of *k*, so it is cached until the next subclass of :class:`Injectable` is created.
 
         '''
-        for c in cls.__mro__:
-            if c in (Injectable, AsyncInjectable):
-                continue
-            if issubclass(c, Injectable) and c != k.target:
-                yield InjectionKey(c)
-                if k.constraints:
-                    yield InjectionKey(c, **k.constraints)
-            elif c is k.target and k.constraints:
-                yield InjectionKey(c)
+        try:
+            return iter(_supplementary_keys_cache[cls, k])
+        except KeyError:
+            pass
+        except TypeError:
+            # Unhashable constraints
+            return _mro_supplementary_keys(cls, k)
+        result = tuple(_mro_supplementary_keys(cls, k))
+        _supplementary_keys_cache[cls, k] = result
+        return iter(result)
 
     @classmethod
     def satisfies_injection_key(cls, k):
@@ -161,6 +164,22 @@ class Injectable:
         return InjectionKey(self.__class__)
 
 
+# (class, InjectionKey) -> tuple of supplementary keys; see Injectable.supplementary_injection_keys
+_supplementary_keys_cache = {}
+
+
+def _mro_supplementary_keys(cls, k):
+    for c in cls.__mro__:
+        if c in (Injectable, AsyncInjectable):
+            continue
+        if issubclass(c, Injectable) and c != k.target:
+            yield InjectionKey(c)
+            if k.constraints:
+                yield InjectionKey(c, **k.constraints)
+        elif c is k.target and k.constraints:
+            yield InjectionKey(c)
+
+
 class DependencyProvider:
     __slots__ = ('provider',
                  'allow_multiple',
@@ -192,9 +211,12 @@ class DependencyProvider:
 
 
     def record_instantiation(self, instance, k, satisfy_against, final):
-        dp = satisfy_against._providers.setdefault(
-            k, DependencyProvider(
-                instance, self.allow_multiple, close=self.close))
+        try:
+            dp = satisfy_against._providers[k]
+        except KeyError:
+            dp = DependencyProvider(
+                instance, self.allow_multiple, close=self.close)
+            satisfy_against._set_provider(k, dp)
         assert dp.needs_quote or dp.provider is instance
         dp.provider = instance
         if final:
@@ -242,6 +264,17 @@ class Injector(Injectable, event.EventListener):
     def __init__(self, *providers,
                  parent_injector=None):
         self._providers = {}
+        # Maps target -> {key: True} for every key in _providers so
+        # that filter need not scan unrelated keys.
+        self._target_keys = {}
+        # key -> (DependencyProvider, injector, generations) for
+        # _get_parent; a miss is (None, None, generations).
+        # generations holds the _generation of each injector searched,
+        # and the entry is stale once any of them changes.  Created on
+        # first lookup.
+        self._resolution_cache = None
+        # Incremented whenever _providers changes
+        self._generation = 0
         self._pending = weakref.WeakSet()
         if parent_injector is None and len(providers) > 0:
             if isinstance(providers[0], Injector):
@@ -306,9 +339,75 @@ class Injector(Injectable, event.EventListener):
         if not isinstance(p, DependencyProvider):
             p = DependencyProvider(p, allow_multiple=allow_multiple, close=close)
         assert isinstance(k, InjectionKey)
+        if not self._register_provider(k, p, replace):
+            return k
+        # p.keys includes k; checking first avoids building adl_keys when nothing listens
+        if self._event_scope.has_listeners(_injector_injection_key, "add_provider", p.keys):
+            self.emit_event(
+                k, "add_provider",
+                p.provider,
+                replace=replace, close=close,
+                allow_multiple=allow_multiple,
+                other_keys=p.keys,
+                adl_keys=p.keys | {_injector_injection_key})
+        return k
+
+    def add_providers(self, providers: typing.Mapping[InjectionKey, typing.Any], *,
+                      allow_multiple=False,
+                      close=True,
+                      replace=False):
+        '''Add providers for a number of dependencies at once.
+
+        :param providers: A mapping from :class:`InjectionKey` to provider.  A provider may be a :class:`DependencyProvider`, in which case *allow_multiple* and *close* are ignored for that provider.  Registering the same *DependencyProvider* under several keys makes those keys share one instantiation.
+
+        *allow_multiple*, *close* and *replace* are as for :meth:`add_provider`.  All keys are checked before any are registered, so if *replace* is False and any key is already provided, :class:`ExistingProvider` is raised and nothing is added.  An exception raised while registering a provider has *injection_key* and *provider* attributes naming the key and provider that failed.
+
+        Rather than an ``add_provider`` event per key, a single ``add_providers`` event is emitted with this injector as the target.  It is dispatched to ``InjectionKey(Injector)`` and to every key registered (including supplementary keys).  The *providers* keyword argument of the event maps each newly registered key to its provider.
+
+        :returns: A list of the keys in *providers*.
+
+        '''
+        def failed(e, k, p):
+            e.injection_key = k
+            e.provider = p.provider if isinstance(p, DependencyProvider) else p
+        to_add = []
+        for k, p in providers.items():
+            try:
+                if not isinstance(k, InjectionKey):
+                    k = InjectionKey(k)
+                if not isinstance(p, DependencyProvider):
+                    p = DependencyProvider(p, allow_multiple=allow_multiple, close=close)
+                if (not replace) and k in self and self._get(k) is not p:
+                    raise ExistingProvider(k)
+            except Exception as e:
+                failed(e, k, p)
+                raise
+            to_add.append((k, p))
+        added = {}
+        all_keys = {_injector_injection_key}
+        for k, p in to_add:
+            try:
+                registered = self._register_provider(k, p, replace)
+            except Exception as e:
+                failed(e, k, p)
+                raise
+            if registered:
+                added[k] = p.provider
+                all_keys |= p.keys
+        if added:
+            self.emit_event(
+                _injector_injection_key, "add_providers",
+                self,
+                providers=added,
+                replace=replace,
+                adl_keys=all_keys)
+        return [k for k, p in to_add]
+
+    def _register_provider(self, k, p, replace):
+        # Returns False if p already provides k, else True
         if k in self:
             if p is self._get(k):
-                return k
+                return False
             existing_provider = self._get(k)
             if replace:
                 existing_provider.provider = p.provider
@@ -316,41 +415,70 @@ class Injector(Injectable, event.EventListener):
             else:
                 raise ExistingProvider(k)
         else:
-            self._providers[k] = p
+            self._set_provider(k, p)
             p.keys.add(k)
         for k2 in k.supplementary_injection_keys(p.provider):
             if k2 not in self:
-                self._providers[k2] = p
+                self._set_provider(k2, p)
                 p.keys.add(k2)
-        self.emit_event(
-            k, "add_provider",
-            p.provider,
-            replace=replace, close=close,
-            allow_multiple=allow_multiple,
-            other_keys=p.keys,
-            adl_keys=p.keys | {InjectionKey(Injector)})
-        return k
+        return True
 
     def replace_provider(self, *args, **kwargs):
         return self.add_provider(*args, **kwargs, replace=True)
 
+    def _set_provider(self, k, p):
+        # All additions to _providers go through here to keep
+        # _target_keys in sync and to invalidate resolutions cached
+        # through this injector.  Replacing the provider inside an
+        # existing DependencyProvider needs no invalidation because
+        # caches hold the DependencyProvider.
+        if self._providers.get(k) is p:
+            return
+        self._providers[k] = p
+        self._target_keys.setdefault(k.target, {})[k] = True
+        self._generation += 1
+
+    #: How many resolutions :meth:`_get_parent` remembers per injector
+    resolution_cache_size = 1024
+
     def _get(self, k):
         return self._providers[k]
 
     def _get_parent(self, k):
         # Returns  DependencyProvider, instantiation_target
+        cache = self._resolution_cache
+        if cache is None:
+            cache = self._resolution_cache = {}
+        entry = cache.get(k)
+        if entry is not None:
+            p, injector, generations = entry
+            i = self
+            for generation in generations:
+                if i._generation != generation:
+                    break
+                i = i.parent_injector
+            else:
+                if p is None:
+                    raise KeyError("{} not found".format(k))
+                return p, (self if p.allow_multiple else injector)
+        elif len(cache) >= self.resolution_cache_size:
+            # Discard the oldest entry
+            del cache[next(iter(cache))]
+        generations = []
         injector = self
         while injector is not None:
-            try:
+            generations.append(injector._generation)
+            p = injector._providers.get(k)
+            if p is not None:
+                cache[k] = (p, injector, tuple(generations))
                 # If the key allows multiple providers, then
                 # satisfy against ourself and store the result in
                 # ourself.  Otherwise if a single provider is
                 # required, then satisfy against the injector
                 # where the key is introduced and store there.
-                p = injector._providers[k]
                 return p, (self if p.allow_multiple else injector)
-            except KeyError:
-                injector = injector.parent_injector
+            injector = injector.parent_injector
+        cache[k] = (None, None, tuple(generations))
         raise KeyError("{} not found".format(k))
 
     def injector_containing(self, k):
@@ -411,7 +539,8 @@ Return the first injector in our parent chain containing *k* or None if there is
             result = {k: True for k in self.parent_injector.filter(target, predicate, stop_at=stop_at)}
         else:  # no stop_at; ended chain
             result = {}
-        result.update({k: True for k in self._providers.keys() if k.target is target and predicate(k)})
+        candidates = self._target_keys.get(target, {})
+        result.update({k: True for k in candidates if k.target is target and predicate(k)})
         return list(result.keys())
 
     def filter_instantiate(self, target, predicate, *, stop_at=None, ready=False):
@@ -788,6 +917,10 @@ Return the first injector in our parent chain containing *k* or None if there is
         self.closed = True
         del providers
         self._providers.clear()
+        self._target_keys.clear()
+        # Invalidates what sub-injectors cached through us
+        self._generation += 1
+        self._resolution_cache = None
         self.parent_injector = None
 
     def __del__(self):
@@ -848,6 +981,14 @@ class InjectionKey:
 
     _target_injection_keys = weakref.WeakKeyDictionary()
 
+    #: If true, keys with constraints (or with non-default
+    #: *_optional*, *_ready* or *_globally_unique*) are interned so
+    #: that constructing an equal key returns the same object.  Dict
+    #: lookups then succeed on identity without calling :meth:`__eq__`.
+    intern_constrained_keys = True
+
+    _constrained_injection_keys = weakref.WeakValueDictionary()
+
     def __new__(cls, target_, *, require_type=False, **constraints):
         assert (cls is InjectionKey) or set(constraints) - \
             cls.POSSIBLE_PARAMETERS, "You cannot subclass InjectionKey with empty constraints"
@@ -863,21 +1004,43 @@ class InjectionKey:
         if (not constraints):
             if target_ in cls._target_injection_keys:
                 return cls._target_injection_keys[target_]
-        self = super().__new__(cls)
         customized = bool(constraints)
         if '_optional' not in constraints:
             try:
                 constraints['_optional'] = constraints.pop('optional')
             except KeyError:
                 pass
-        for k in _INJECTION_KEY_DEFAULTS:
-            self.__dict__[k] = constraints.pop(
-                '_' + k, _INJECTION_KEY_DEFAULTS[k])
-
+        attributes = {k: constraints.pop('_' + k, _INJECTION_KEY_DEFAULTS[k])
+                      for k in _INJECTION_KEY_DEFAULTS}
+        try:
+            frozen_constraints = frozenset(constraints.items())
+            key_hash = hash(target_) + hash(frozen_constraints)
+        except TypeError:
+            # Unhashable constraints; the key can be constructed but not hashed.
+            frozen_constraints = None
+        intern_key = None
+        if customized and frozen_constraints is not None and cls.intern_constrained_keys:
+            # Types are included so that for example _optional=1 and _optional=True are distinct.
+            intern_key = (cls, target_,
+                          frozenset((k, v.__class__, v) for k, v in constraints.items()),
+                          *((v.__class__, v) for v in attributes.values()))
+            try:
+                self = cls._constrained_injection_keys.get(intern_key)
+            except TypeError:
+                intern_key = self = None
+            if self is not None:
+                return self
+        self = super().__new__(cls)
+        self.__dict__.update(attributes)
         self.__dict__['constraints'] = dict(constraints)
         self.__dict__['target'] = target_
+        if frozen_constraints is not None:
+            self.__dict__['_frozen_constraints'] = frozen_constraints
+            self.__dict__['_hash'] = key_hash
         if (not customized) and not isinstance(target_, (str, int, float)):
             cls._target_injection_keys[target_] = self
+        elif intern_key is not None:
+            cls._constrained_injection_keys[intern_key] = self
         return self
 
     def __getattr__(self, k):
@@ -899,19 +1062,20 @@ class InjectionKey:
         raise TypeError('InjectionKeys are immutable')
 
     def __hash__(self):
-        return hash(self.target) + sum([hash(k) for k in self.constraints.keys()]) + \
-            sum([hash(v) for v in self.constraints.values()])
+        try:
+            return self.__dict__['_hash']
+        except KeyError:
+            # Raises TypeError for unhashable constraints
+            return hash(self.target) + hash(frozenset(self.constraints.items()))
 
     def __eq__(self, other):
+        if self is other:
+            return True
         if not isinstance(other, type(self)):
             return False
         if self.target != other.target:
             return False
-        if len(self.constraints) != len(other.constraints):
-            return False
-        if all(map(lambda k: self.constraints[k] == other.constraints[k], self.constraints.keys())):
-            return True
-        return False
+        return self.constraints == other.constraints
 
     def supplementary_injection_keys(self, p):
         if (isinstance(p, type) and issubclass(p, Injectable)) or \
@@ -920,10 +1084,15 @@ class InjectionKey:
         else:
             if p.__class__ in (int, float, str, list, tuple, types.FunctionType):
                 return
-            for c in p.__class__.__mro__:
-                if c is p.__class__:
-                    continue
-                yield InjectionKey(c)
+            result = _class_supplementary_keys_cache.get(p.__class__)
+            if result is None:
+                result = tuple(InjectionKey(c) for c in p.__class__.__mro__[1:])
+                _class_supplementary_keys_cache[p.__class__] = result
+            yield from result
+
+
+# Supplementary keys for providers that are not Injectable depend only on the class of the provider
+_class_supplementary_keys_cache = weakref.WeakKeyDictionary()
 
 
 # Used in Injector.__init__
@@ -1173,18 +1342,18 @@ class AsyncInjector(Injectable):
 
     def __init__(self, injector, loop):
         self.injector = injector
-        self.injector.replace_provider(self)
         self.loop = loop
-        # For methods that injector has but we do not, then call the method on our
-        # injector.  This is a lot like inheritance but does not make us a
-        # subclass.
-        for k in list(Injector.__dict__.keys()) + list(event.EventListener.__dict__.keys()):
-            if not isinstance(getattr(Injector, k), types.FunctionType):
-                continue
-
-            if hasattr(self, k):
-                continue
-            setattr(self, k, getattr(self.injector, k))
+        # Equivalent to injector.replace_provider(self) but without
+        # emitting an add_provider event; one of these is constructed
+        # for every AsyncInjectable.  AsyncInjector has no
+        # supplementary injection keys.
+        existing = injector._providers.get(_async_injector_injection_key)
+        if existing is None:
+            dp = DependencyProvider(self)
+            injector._set_provider(_async_injector_injection_key, dp)
+            dp.keys.add(_async_injector_injection_key)
+        else:
+            existing.provider = self
 
     def claim(self, claimed_by=True):
         if self.injector.is_claimed:
@@ -1263,6 +1432,36 @@ class AsyncInjector(Injectable):
         return [z for z in zipped if z[1] is not None]
 
 
+class _delegate_to_injector:
+
+    # For methods that Injector has but AsyncInjector does not, call
+    # the method on the underlying injector.  This is a lot like
+    # inheritance but does not make AsyncInjector a subclass.
+
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        return getattr(instance.injector, self.name)
+
+
+for k in list(Injector.__dict__.keys()) + list(event.EventListener.__dict__.keys()):
+    if k.startswith('__') and k.endswith('__'):
+        continue
+    if not isinstance(getattr(Injector, k), types.FunctionType):
+        continue
+    if hasattr(AsyncInjector, k):
+        continue
+    setattr(AsyncInjector, k, _delegate_to_injector(k))
+del k
+
+_async_injector_injection_key = InjectionKey(AsyncInjector)
+
+
 async def _handle_async_deps(obj, cycle_set):
     if cycle_set is None:
         cycle_set = set()
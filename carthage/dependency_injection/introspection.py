@@ -13,6 +13,9 @@ import dataclasses
 
 _current_instantiation = contextvars.ContextVar('current_instantiation', default=None)
 
+#: The :class:`~carthage.dependency_injection.profiler.InstantiationProfiler` currently recording, if any
+_active_profiler = None
+
 __all__ = []
 
 
@@ -43,18 +46,24 @@ class BaseInstantiationContext:
     def dependency_progress(self, key, context):
         '''Indicate that this instantiation has a dependency on *key*, currently in progress, with state tracked by *context*.'''
         self.dependencies_waiting.setdefault(key, context)
+        if _active_profiler:
+            _active_profiler.dependency_progress(self, key, context)
 
     def dependency_final(self, key, context):
         try:
             del self.dependencies_waiting[key]
         except KeyError:
             pass
+        if _active_profiler:
+            _active_profiler.dependency_final(self, key, context)
 
     def __enter__(self):
         self.parent = _current_instantiation.get()
         if not self.parent:
             instantiation_roots.add(self)
         self.reset_token = _current_instantiation.set(self)
+        if _active_profiler:
+            _active_profiler.context_entered(self)
         return self
 
     def __exit__(self, *args):
@@ -67,6 +76,8 @@ class BaseInstantiationContext:
         self._done = True
         if not self.parent:
             instantiation_roots.remove(self)
+        if _active_profiler:
+            _active_profiler.context_done(self)
 
     def __str__(self):
         res = self.description
@@ -197,9 +208,7 @@ class InstantiationContext(BaseInstantiationContext, InjectedDependencyInspector
             if not parent:
                 continue
             parent.dependency_progress(self.key, self)
-        self.injector.emit_event(self.key, "dependency_progress",
-                                 self,
-                                 adl_keys=self.provider.keys | {base.InjectionKey(base.Injector)})
+        self._emit_dependency_event("dependency_progress")
 
     def final(self):
         from .base import is_obj_ready
@@ -218,9 +227,15 @@ class InstantiationContext(BaseInstantiationContext, InjectedDependencyInspector
             # calls progress soon to recover from that.
             parent.dependency_final(self.key, self)
         if obj_ready or not ctx.ready:
-            self.injector.emit_event(self.key,
-                                     "dependency_final", self,
-                                     adl_keys=self.provider.keys | {base.InjectionKey(base.Injector)})
+            self._emit_dependency_event("dependency_final")
+
+    def _emit_dependency_event(self, event):
+        # Check for listeners before building adl_keys; almost always nobody is listening.
+        scope = self.injector._event_scope
+        if scope.has_listeners(self.key, event, self.provider.keys) \
+           or scope.has_listeners(base._injector_injection_key, event):
+            self.injector.emit_event(self.key, event, self,
+                                     adl_keys=self.provider.keys | {base._injector_injection_key})
 
     def get_dependencies(self):
         return get_dependencies_for(self.provider.provider, self.injector)
@@ -0,0 +1,213 @@
+# Copyright (C)  2023, Hadron Industries, Inc.
+# Carthage is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License version 3
+# as published by the Free Software Foundation. It is distributed
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the file
+# LICENSE for details.
+
+'''
+Profile instantiations performed by :class:`~carthage.dependency_injection.Injector`, along with other instantiation contexts such as setup tasks and :meth:`~carthage.dependency_injection.AsyncInjectable.async_become_ready`.  Typical usage::
+
+    profiler = InstantiationProfiler()
+    with profiler:
+        await layout.generate()
+    print(profiler.format_report())
+    profiler.write_chrome_trace('instantiation.json')
+
+The resulting trace can be loaded into ``chrome://tracing`` or `Perfetto <https://ui.perfetto.dev>`_.
+
+'''
+
+from __future__ import annotations
+import dataclasses
+import json
+import time
+import typing
+from pathlib import Path
+from . import introspection
+
+__all__ = []
+
+
+@dataclasses.dataclass(eq=False)
+class InstantiationRecord:
+
+    '''Timing information about one :class:`~carthage.dependency_injection.introspection.BaseInstantiationContext`.  Times are from :func:`time.monotonic`.
+    '''
+
+    description: str
+    kind: str  #: Class name of the context
+    start: float
+    parent: typing.Optional[InstantiationRecord] = None
+    end: typing.Optional[float] = None
+
+    #: Total time spent with at least one dependency outstanding
+    blocked: float = 0.0
+    blocked_since: typing.Optional[float] = None
+    children: list = dataclasses.field(default_factory=list, repr=False)
+    #: Records of dependencies this instantiation was blocked on
+    waited_on: list = dataclasses.field(default_factory=list, repr=False)
+
+    @property
+    def wall_time(self):
+        return self.end - self.start
+
+    @property
+    def unblocked_time(self):
+        return self.wall_time - self.blocked
+
+
+__all__ += ['InstantiationRecord']
+
+
+class InstantiationProfiler:
+
+    '''
+    Records an :class:`InstantiationRecord` for every instantiation context entered while the profiler is active.  Use as a context manager or call :meth:`start` and :meth:`stop`.  Only one profiler may be active at a time.
+
+    '''
+
+    def __init__(self):
+        self.records: list[InstantiationRecord] = []
+        self.started = None
+        self.stopped = None
+
+    def start(self):
+        if introspection._active_profiler is not None:
+            raise RuntimeError('An InstantiationProfiler is already active')
+        self.started = time.monotonic()
+        self.stopped = None
+        introspection._active_profiler = self
+
+    def stop(self):
+        if introspection._active_profiler is self:
+            introspection._active_profiler = None
+        self.stopped = time.monotonic()
+        # Close out anything still running so reports are consistent.
+        for r in self.records:
+            if r.blocked_since is not None:
+                r.blocked += self.stopped - r.blocked_since
+                r.blocked_since = None
+            if r.end is None:
+                r.end = self.stopped
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+        return False
+
+    # Called from BaseInstantiationContext
+
+    def context_entered(self, context):
+        parent = getattr(context.parent, '_profile_record', None)
+        try:
+            description = context.description
+        except Exception:
+            description = f'<{context.__class__.__name__}>'
+        record = InstantiationRecord(
+            description=description,
+            kind=context.__class__.__name__,
+            start=time.monotonic(),
+            parent=parent)
+        if parent:
+            parent.children.append(record)
+        context._profile_record = record
+        self.records.append(record)
+
+    def context_done(self, context):
+        record = getattr(context, '_profile_record', None)
+        if record is None:
+            return
+        now = time.monotonic()
+        if record.blocked_since is not None:
+            record.blocked += now - record.blocked_since
+            record.blocked_since = None
+        record.end = now
+
+    def dependency_progress(self, context, key, dependency_context):
+        record = getattr(context, '_profile_record', None)
+        if record is None:
+            return
+        dependency_record = getattr(dependency_context, '_profile_record', None)
+        if dependency_record is not None and dependency_record not in record.waited_on:
+            record.waited_on.append(dependency_record)
+        if record.blocked_since is None and context.dependencies_waiting:
+            record.blocked_since = time.monotonic()
+
+    def dependency_final(self, context, key, dependency_context):
+        record = getattr(context, '_profile_record', None)
+        if record is not None and record.blocked_since is not None and not context.dependencies_waiting:
+            record.blocked += time.monotonic() - record.blocked_since
+            record.blocked_since = None
+
+    # Reporting
+
+    def critical_path(self) -> list[InstantiationRecord]:
+        '''
+        The chain of instantiations that determined when the last root instantiation finished.  Starting from the root instantiation that finished last, repeatedly follow the dependency it was blocked on that finished last.
+        '''
+        roots = [r for r in self.records if r.parent is None and r.end is not None]
+        if not roots:
+            return []
+        path = [max(roots, key=lambda r: r.end)]
+        while True:
+            waited_on = [c for c in path[-1].waited_on if c.end is not None and c not in path]
+            if not waited_on:
+                return path
+            path.append(max(waited_on, key=lambda c: c.end))
+
+    def format_report(self, limit=20):
+        finished = [r for r in self.records if r.end is not None]
+        lines = [f'{len(self.records)} instantiations recorded']
+        lines.append(f'Top {limit} by wall time (wall / blocked seconds):')
+        for r in sorted(finished, key=lambda r: r.wall_time, reverse=True)[:limit]:
+            lines.append(f'  {r.wall_time:9.3f} {r.blocked:9.3f}  {r.description}')
+        lines.append('Critical path (wall / unblocked seconds):')
+        for r in self.critical_path():
+            lines.append(f'  {r.wall_time:9.3f} {r.unblocked_time:9.3f}  {r.description}')
+        return '\n'.join(lines)
+
+    def chrome_trace(self):
+        '''
+        :returns: A dict in the Chrome trace event format.  Overlapping instantiations are packed into separate threads, so each thread holds a properly nested sequence of complete events.
+        '''
+        origin = self.started if self.started is not None else 0.0
+        critical = set(map(id, self.critical_path()))
+        lanes: list[list[InstantiationRecord]] = []
+        events = []
+        for r in sorted((r for r in self.records if r.end is not None),
+                        key=lambda r: (r.start, -r.end)):
+            for tid, lane in enumerate(lanes):
+                # Drop records that have finished; the remaining stack must enclose r
+                while lane and lane[-1].end <= r.start:
+                    lane.pop()
+                if not lane or lane[-1].end >= r.end:
+                    lane.append(r)
+                    break
+            else:
+                tid = len(lanes)
+                lanes.append([r])
+            events.append(dict(
+                name=r.description,
+                cat=r.kind + (',critical' if id(r) in critical else ''),
+                ph='X',
+                pid=1,
+                tid=tid,
+                ts=(r.start - origin) * 1e6,
+                dur=r.wall_time * 1e6,
+                args=dict(
+                    blocked=r.blocked,
+                    parent=r.parent.description if r.parent else None,
+                    critical_path=id(r) in critical,
+                )))
+        return dict(traceEvents=events, displayTimeUnit='ms')
+
+    def write_chrome_trace(self, path):
+        Path(path).write_text(json.dumps(self.chrome_trace()))
+
+
+__all__ += ['InstantiationProfiler']
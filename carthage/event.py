@@ -13,27 +13,80 @@ import weakref
 from .utils import possibly_async
 
 
+# loop -> an already complete future whose result is []
+_no_listeners_futures = weakref.WeakKeyDictionary()
+
+
+def _no_listeners(loop):
+    # What emitting an event nobody is listening to produces: a done
+    # future, as gathering zero callbacks would produce.  One is
+    # shared per loop, so callers must not modify its result.
+    try:
+        return _no_listeners_futures[loop]
+    except KeyError:
+        pass
+    future = _no_listeners_futures[loop] = loop.create_future()
+    future.set_result([])
+    return future
+
+
+class _Listener:
+
+    __slots__ = ('events', 'futures', 'ordered', 'last')
+
+    def __init__(self, events, ordered=False):
+        self.events = events
+        #: Pending asynchronous calls to the callback
+        self.futures = set()
+        self.ordered = ordered
+        #: For ordered listeners, the most recently scheduled call
+        self.last = None
+
+
+async def _run_after(previous, coro):
+    # asyncio.wait rather than await so that a failure in the previous
+    # call does not propagate, but our own cancellation does.
+    await asyncio.wait((previous,))
+    return await coro
+
+
+def _done_future(loop, result):
+    future = loop.create_future()
+    future.set_result(result)
+    return future
+
+
+# Incremented whenever a scope is created below the root of an existing
+# tree, which is the only thing that changes which scope an object
+# belongs to.  Cached scope lookups are only valid for one epoch.
+_scope_epoch = 0
+
+
 class EventScope:
 
     '''
-    Typically most objects that have event listener support never have listeners attached.  So it is desirable to separate the ability to listen for events from the data structures associated with actually doing so.  An *EventScope* is attached to a *target* when a *target* gains the first event subscription.  When an object lower in the hierarchy gains an event subscription, then :meth:`.break_at` is called to create a new *EventScope* and reparent targets lower in the tree to that new scope.
+    Typically most objects that have event listener support never have listeners attached.  So it is desirable to separate the ability to listen for events from the data structures associated with actually doing so.  An *EventScope* is attached to a *target* when a *target* gains the first event subscription.  When an object lower in the hierarchy gains an event subscription, then :meth:`.break_at` is called to create a new *EventScope* for that object.
+
+    Scopes do not track the objects they cover.  Each :class:`EventListener` points at its parent, and finds its scope by walking up to the nearest object that owns one.  The result is cached until the next call to :meth:`break_at` creates a scope.
     '''
 
-    def __init__(self, target, parent: EventScope = None):
+    def __init__(self, target):
         self.target = weakref.ref(target)
         self.listeners = {}
-        self.parent = parent
-        if parent:
-            self.children, self.finalizers = parent.find_prune_children(target)
-        else:
-            self.children = {id(target): weakref.WeakSet()}
-            self.finalizers = {}
-        for v in self.children.values():
-            for c in v:
-                if c._event_scope is parent:
-                    c._event_scope = self
-                else:
-                    c._event_scope._update_parent(parent, self)
+        #: event -> {key: number of listeners}; lets emit decide cheaply whether anyone is listening
+        self.event_index = {}
+        self._parent = None
+        self._parent_epoch = -1
+
+    @property
+    def parent(self):
+        '''The scope of the parent of our target, or *None* at the root.'''
+        if self._parent_epoch != _scope_epoch:
+            target = self.target()
+            event_parent = target._event_parent if target is not None else None
+            self._parent = event_parent._event_scope if event_parent is not None else None
+            self._parent_epoch = _scope_epoch
+        return self._parent
 
     def break_at(self, target: EventListener):
         '''
@@ -41,122 +94,139 @@ class EventScope:
 
         Returns an :class:`EventScope` that receives events for the given *target* and its children, but no parent objects.
         '''
+        global _scope_epoch
         if self.target() is target:
             return self
-        scope = type(self)(target, parent=self)
-        target._event_scope = scope
+        scope = type(self)(target)
+        target._event_own_scope = scope
+        _scope_epoch += 1
         return scope
 
     def add_child(self, parent, child):
         '''Must be called for any object that has *self* as an *EventScope* and is not *self.target*.'''
-        assert id(parent) in self.children
-        child._event_parent_id = id(parent)
-        self.children[id(parent)].add(child)
-        self.children[id(child)] = weakref.WeakSet()
-        fin = weakref.finalize(child, self._finalize_child, self.children, self.finalizers, id(child))
-        fin.atexit = False
-        self.finalizers[id(child)] = fin
-
-    def find_prune_children(self, new_target):
-        children = {}
-        finalizers = {}
-
-        def recurse(elt):
-            for c in self.children[id(elt)]:
-                recurse(c)
-            children[id(elt)] = self.children[id(elt)]
-            del self.children[id(elt)]
-            try:
-                del self.finalizers[id(elt)]
-            except KeyError:
-                pass
-            fin = weakref.finalize(elt, self._finalize_child, children, finalizers, id(elt))
-            fin.atexit = False
-            finalizers[id(elt)] = fin
-        recurse(new_target)
-        self.children[new_target._event_parent_id].remove(new_target)
-        return children, finalizers
-
-    @staticmethod
-    def _finalize_child(children, finalizers, id):
-        try:
-            del children[id]
-        except BaseException:
-            pass
+        child._event_parent = parent
+
+    def _index_events(self, k, events, delta):
+        for e in events:
+            keys = self.event_index.setdefault(e, {})
+            count = keys.get(k, 0) + delta
+            if count > 0:
+                keys[k] = count
+            else:
+                keys.pop(k, None)
+                if not keys:
+                    del self.event_index[e]
+
+    def add_listener(self, k, event, callback, ordered=False):
+        d = self.listeners.setdefault(k, {})
         try:
-            del finalizers[id]
-        except BaseException:
+            self._index_events(k, d[callback].events, -1)
+        except KeyError:
             pass
-
-    def _update_parent(self, old_parent, new_parent):
-        p = self.parent
-        assert p is not old_parent
-        while p is not None:
-            if p is new_parent:
-                return
-            if p.parent is old_parent:
-                p.parent = new_parent
-                return
-            p = p.parent
-        raise ValueError('old_parent is not  in the parent chain')
-
-    def add_listener(self, k, event, callback):
-        d = self.listeners.setdefault(k, {})
-        d[callback] = (event, set())
+        d[callback] = _Listener(event, ordered)
+        self._index_events(k, event, 1)
 
     def remove_listener(self, k, callback):
         d = self.listeners[k]
         try:
-            events, futures = d[callback]
+            listener = d[callback]
             del d[callback]
-            return futures
         except KeyError:
             # We prefer our message
             raise KeyError(f'{callback} not registered as a listener for {k}') from None
+        self._index_events(k, listener.events, -1)
+        return listener.futures
+
+    def has_listeners(self, k, event, adl_keys=()):
+        '''
+        :return: True if some listener in this scope or a parent scope would receive *event* dispatched to *k* or one of *adl_keys*.
+
+        Does not allocate; used to skip building callback tasks for the common case where nothing is listening.
+        '''
+        scope = self
+        while scope is not None:
+            keys = scope.event_index.get(event)
+            if keys:
+                if k in keys:
+                    return True
+                for ak in adl_keys:
+                    if ak in keys:
+                        return True
+            scope = scope.parent
+        return False
 
     def emit(self, loop, k, event, target, *args,
              adl_keys=set(),
              **kwargs):
-        def gen_callback(futures):
+        '''
+        :return: A future producing the results of any callbacks.  If nothing is listening, a shared already-complete future for *loop* is returned.
+        '''
+        if not self.has_listeners(k, event, adl_keys):
+            return _no_listeners(loop)
+        return self._emit(loop, k, event, target, *args, adl_keys=adl_keys, **kwargs)
+
+    #: If True, a callback that returns something other than a coroutine has its result recorded directly.  Only coroutines are wrapped in tasks.  If False, every call is wrapped in a task, as Carthage historically did.  Callbacks are called synchronously within :meth:`emit` either way.
+    inline_sync_callbacks = True
+
+    def _emit(self, loop, k, event, target, *args,
+              adl_keys=set(),
+              **kwargs):
+        def gen_callback(listener):
             def callback(future):
                 # ignore the result
                 try:
                     future.result()
                 except BaseException:
                     pass
-                futures.remove(future)
+                listener.futures.discard(future)
+                if listener.last is future:
+                    listener.last = None
             return callback
         if not isinstance(adl_keys, set):
             adl_keys = set(adl_keys)
         target_keys = {k} | adl_keys
-        result_futures = []
-        if self.parent:
-            result_futures.append(self.parent.emit(
+        # Results are either values of callbacks run inline or futures
+        results = []
+        pending = False
+        if self.parent and self.parent.has_listeners(k, event, adl_keys):
+            results.append(self.parent._emit(
                 loop, k, event, target, adl_keys=adl_keys,
                 **kwargs))
+            pending = True
+        event_keys = self.event_index.get(event, {})
         for ck in target_keys:
-            try:
-                d = self.listeners[ck]
-            except KeyError:
+            if ck not in event_keys:
                 continue
-            for callback, (events, futures) in d.items():
-                if event in events:
-                    future = loop.create_task(
-                        possibly_async(callback(
-                            key=ck, event=event, target=target, *args,
-                            target_key=k, **kwargs)))
-                    result_futures.append(future)
-                    futures.add(future)
-                    future.add_done_callback(gen_callback(futures))
+            d = self.listeners[ck]
+            for callback, listener in list(d.items()):
+                if event not in listener.events:
+                    continue
+                result = callback(
+                    key=ck, event=event, target=target, *args,
+                    target_key=k, **kwargs)
+                if not asyncio.iscoroutine(result):
+                    if self.inline_sync_callbacks:
+                        results.append(_done_future(loop, result) if pending else result)
+                        continue
+                    result = possibly_async(result)
+                if not pending:
+                    results = [_done_future(loop, r) for r in results]
+                    pending = True
+                if listener.ordered and listener.last is not None:
+                    result = _run_after(listener.last, result)
+                future = loop.create_task(result)
+                if listener.ordered:
+                    listener.last = future
+                results.append(future)
+                listener.futures.add(future)
+                future.add_done_callback(gen_callback(listener))
         del args
         del kwargs
 
-        if result_futures:
-            return asyncio.gather(*result_futures)
+        if pending:
+            return asyncio.gather(*results)
         else:
-            future = loop.create_future()
-            future.set_result([])
-            return future
+            return _done_future(loop, results)
 
 
 class EventListener:
@@ -165,23 +235,41 @@ class EventListener:
 
 '''
 
+    #: The :class:`EventListener` whose scope we share unless we have our own
+    _event_parent = None
+    #: The :class:`EventScope` targeted at this object, if any
+    _event_own_scope = None
+    _event_scope_cache = None
+    _event_scope_epoch = -1
+
     def __init__(self, event_scope=None):
         super().__init__()
-        if event_scope:
-            self._event_scope = event_scope
-            return
-        er = getattr(self, '_event_scope', None)
-        if isinstance(er, EventScope):
+        if self._event_parent is not None or self._event_own_scope is not None:
             return
-        try:
-            self._event_scope = self.parent._event_scope
-            self._event_scope.add_child(self.parent, self)
+        if event_scope:
+            self._event_parent = event_scope.target()
             return
-        except AttributeError:
-            pass
-        self._event_scope = EventScope(self)
+        parent = getattr(self, 'parent', None)
+        if isinstance(parent, EventListener):
+            self._event_parent = parent
+        # Otherwise we are a root; our scope is created on first use.
+
+    @property
+    def _event_scope(self):
+        if self._event_scope_epoch == _scope_epoch:
+            return self._event_scope_cache
+        node = self
+        while node._event_own_scope is None:
+            if node._event_parent is None:
+                node._event_own_scope = EventScope(node)
+                break
+            node = node._event_parent
+        scope = node._event_own_scope
+        self._event_scope_cache = scope
+        self._event_scope_epoch = _scope_epoch
+        return scope
 
-    def add_event_listener(self, key, events, callback):
+    def add_event_listener(self, key, events, callback, *, ordered=False):
         '''
          :param key: an :class:`InjectionKey` or similar key toward which the event will be dispatched.
 
@@ -191,13 +279,15 @@ class EventListener:
 
             callback(key, event, target, *event_args, **event_kwargs)
 
-        The *callback* may be asynchronous.
+        The *callback* is called synchronously when the event is emitted.  If it returns a coroutine, that coroutine is run in a task; otherwise no task is created.
+
+        :param ordered: If True, asynchronous calls to *callback* run one at a time in the order events were emitted.  Otherwise they run concurrently.
         '''
         self._event_scope.break_at(self)
         if isinstance(events, str):
             events = {events}
         events = frozenset(events)
-        self._event_scope.add_listener(key, events, callback)
+        self._event_scope.add_listener(key, events, callback, ordered=ordered)
 
     def remove_event_listener(self, key, callback):
         '''
@@ -216,6 +306,8 @@ class EventListener:
                 loop = self.loop
             except BaseException:
                 loop = asyncio.get_event_loop()
+        if not self._event_scope.has_listeners(key, event, adl_keys):
+            return _no_listeners(loop)
         return self._event_scope.emit(loop, key, event, target,
                                       *args,
                                       **kwargs,
@@ -223,7 +315,7 @@ class EventListener:
                                       scope=self)
 
     @contextlib.contextmanager
-    def event_listener_context(self, key, events, callback):
+    def event_listener_context(self, key, events, callback, *, ordered=False):
         '''
         Within the scope of the context, *callback* is registered as a listener for the *events* directed at *key*.
         A callback may be removed prematurely if  it is registered for the same key on the same scope by multiple calls to this function or :meth:`add_event_listener`.
@@ -231,10 +323,9 @@ class EventListener:
         :return: A set of futures representing pending  calls to the callback.
 
         '''
-        self.add_event_listener(key, events, callback)
+        self.add_event_listener(key, events, callback, ordered=ordered)
         try:
-            ignore, futures = self._event_scope.listeners[key][callback]
-            yield futures
+            yield self._event_scope.listeners[key][callback].futures
         finally:
             self.remove_event_listener(key, callback)
 
@@ -5,7 +5,16 @@
 # WITHOUT ANY WARRANTY; without even the implied warranty of
 # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the file
 # LICENSE for details.
+import collections
 import collections.abc
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import random
+import threading
+import time
 
 import yaml
 from pathlib import Path
@@ -17,6 +26,8 @@ from .dependency_injection import *
 from .config import ConfigLayout
 from .utils import memoproperty
 
+logger = logging.getLogger('carthage.kvstore')
+
 
 __all__ = []
 
@@ -41,8 +52,18 @@ __all__ += ['persistent_seed_path']
                    )
 class KvStore(Injectable):
 
+    '''
+    A persistent key-value store backed by LMDB.
+
+    :param max_size: The initial size of the LMDB map.  When a write transaction run through :meth:`run_transaction` (which includes all :class:`KvDomain` writes) fills the map, the map is grown by :attr:`map_growth_factor` up to :attr:`max_map_size` and the transaction is retried.
+    '''
+
+    map_growth_factor = 2
+    max_map_size = 2**40
+
     def __init__(
             self, store_dir="persistent_assignments", max_size=4*2**30,
+            *, max_dbs=512,
             **kwargs):
         super().__init__(**kwargs)
         store_path = Path(store_dir)
@@ -51,10 +72,15 @@ class KvStore(Injectable):
     
         self.environment = lmdb.Environment(
             str(store_path), subdir=True,
-            max_dbs=512,
+            max_dbs=max_dbs,
             map_size=max_size,
             create=True,
             writemap=True)
+        self._local = threading.local()
+        #: domain name -> KvCache for domains with read caching enabled
+        self._caches = {}
+        # The last LMDB transaction id reflected in _caches
+        self._known_txnid = self.environment.info()['last_txnid']
         if self.persistent_seed_path:
             persistent_seed_path = Path(self.persistent_seed_path)
             if persistent_seed_path.exists():
@@ -64,7 +90,208 @@ class KvStore(Injectable):
     def close(self):
         self.environment.close()
 
-    def domain(self, d:str, include_in_dump):
+    @contextlib.contextmanager
+    def transaction(self, write=True):
+        '''
+        A context manager yielding an LMDB transaction.  :class:`KvDomain` operations on this store within the context (in the same thread) join the transaction rather than starting their own, so a batch of operations commits once.  Typical usage::
+
+            with kvstore.transaction():
+                for link in links: pool._assign(...)
+
+        The transaction commits when the outermost context exits normally and aborts if it exits with an exception.  Nested calls join the outer transaction.
+
+        :param write: If False, a read-only transaction is started.  Writes within a read-only transaction fail.
+        '''
+        if getattr(self._local, 'txn', None) is not None:
+            with self._begin(write) as txn:
+                yield txn
+            return
+        written = set() if write else None
+        try:
+            with self._environment_begin(write) as txn:
+                if write:
+                    txnid = txn.id()
+                    # A write transaction's id is one more than the last committed
+                    if txnid-1 != self._known_txnid:
+                        self._invalidate_caches(txnid-1)
+                    cache_valid = True
+                else:
+                    cache_valid = self._check_snapshot(txn.id())
+                self._local.txn = txn
+                self._local.write = write
+                self._local.cache_valid = cache_valid
+                self._local.written = written
+                try:
+                    yield txn
+                finally:
+                    self._local.txn = self._local.written = None
+        except BaseException:
+            # Aborted; caches stored into during the transaction may
+            # hold values that were never committed
+            if write:
+                for cache in written: cache.clear()
+            raise
+        if write:
+            last = self.environment.info()['last_txnid']
+            # last is txnid-1 if nothing was written
+            if last == txnid:
+                self._known_txnid = txnid
+            elif last != txnid-1:
+                self._invalidate_caches(last)
+
+    def _environment_begin(self, write):
+        try:
+            return self.environment.begin(write=write)
+        except lmdb.MapResizedError:
+            # Another process grew the map; adopt its size
+            self.environment.set_mapsize(0)
+            return self.environment.begin(write=write)
+
+    def run_transaction(self, func, *args, **kwargs):
+        '''
+        Call ``func(txn, *args, **kwargs)`` within a write :meth:`transaction` and return its result.  If the LMDB map fills, the transaction is aborted, the map is grown, and *func* is called again in a new transaction, so *func* must be safe to repeat.  Within an enclosing transaction, *func* is simply called; the outermost :meth:`run_transaction` (if any) handles retry.
+        '''
+        txn = getattr(self._local, 'txn', None)
+        if txn is not None:
+            if not self._local.write:
+                raise RuntimeError('Cannot start a write transaction within a read-only transaction')
+            return func(txn, *args, **kwargs)
+        while True:
+            try:
+                with self.transaction() as txn:
+                    return func(txn, *args, **kwargs)
+            except lmdb.MapFullError:
+                if not self._grow_map(): raise
+
+    def _grow_map(self):
+        # Returns False if the map cannot grow further
+        size = self.environment.info()['map_size']
+        if size >= self.max_map_size: return False
+        new_size = min(int(size*self.map_growth_factor), self.max_map_size)
+        logger.info(f'Growing {self.environment.path()} from {size} to {new_size} bytes')
+        self.environment.set_mapsize(new_size)
+        return True
+
+    def stats(self):
+        '''
+        :returns: A dict describing the store: the map size and how much of it is in use, the number of reader slots in use, the number of entries in each domain, and for each :class:`HintedAssignments` domain that has seen contention, the total ``conflicts`` and ``retries`` recorded by :meth:`_record_contention`.
+        '''
+        info = self.environment.info()
+        stat = self.environment.stat()
+        pages_used = info['last_pgno']+1
+        domains = {}
+        contention = {}
+        contention_prefix = kv_key('contention', '')
+        with self.transaction(write=False) as txn, txn.cursor() as csr:
+            for key, value in csr:
+                d = _key_domain(key)
+                domains[d] = domains.get(d, 0)+1
+                if key.startswith(contention_prefix):
+                    conflicts, retries = value.split()
+                    contention[str(key[len(contention_prefix):], 'utf-8')] = dict(
+                        conflicts=int(conflicts), retries=int(retries))
+        return dict(
+            path=self.environment.path(),
+            map_size=info['map_size'],
+            page_size=stat['psize'],
+            pages_used=pages_used,
+            bytes_used=pages_used*stat['psize'],
+            map_used=pages_used*stat['psize']/info['map_size'],
+            entries=stat['entries'],
+            readers_in_use=info['num_readers'],
+            max_readers=info['max_readers'],
+            domains=domains,
+            contention=contention,
+        )
+
+    def _record_contention(self, domain, conflicts, retries):
+        # Add to the persistent conflict and retry totals for an
+        # assignments domain so that stats() can report contention
+        # seen by any process sharing the store.
+        key = kv_key('contention', domain)
+        def record(txn):
+            old = txn.get(key)
+            if old:
+                old_conflicts, old_retries = old.split()
+                conflicts_total = int(old_conflicts)+conflicts
+                retries_total = int(old_retries)+retries
+            else: conflicts_total, retries_total = conflicts, retries
+            txn.put(key, b'%d %d' % (conflicts_total, retries_total))
+        self.run_transaction(record)
+
+    def sweep_assignments(self, live, *, dry_run=False):
+        '''
+        Remove assignments held by keys that no longer exist from every :class:`HintedAssignments` domain in the store.  Each assignments domain is read in one cursor pass and all deletions happen in a single transaction.  The hint for each dead key is removed as well, and any :class:`AllocationBitmap` for the domain is marked for rebuild.
+
+        :param live: Called with the :class:`HintedAssignments` domain (without the ``/assignments`` suffix) and the key holding an assignment; returns False if the key is dead.
+
+        :param dry_run: If True, report what would be removed without changing the store.
+
+        :returns: A dict mapping each domain with dead keys to a list of ``(assignment, key)`` tuples.
+        '''
+        def sweep(txn):
+            report = {}
+            with txn.cursor() as csr:
+                found = csr.first()
+                while found:
+                    d = _key_domain(csr.key())
+                    domain_key = kv_key(d, '')
+                    if d.endswith('/assignments'):
+                        base = d[:-len('/assignments')]
+                        for key, value in csr:
+                            if not key.startswith(domain_key): break
+                            key_str = str(value, 'utf-8')
+                            if not live(base, key_str):
+                                report.setdefault(base, []).append(
+                                    (str(key[len(domain_key):], 'utf-8'), key_str))
+                    # Skip the rest of the domain; 0xff never appears in UTF-8
+                    found = csr.set_range(domain_key+b'\xff')
+            if dry_run: return report
+            for base, dead in report.items():
+                for assignment, key in dead:
+                    txn.delete(kv_key(base+'/assignments', assignment))
+                    txn.delete(kv_key(base+'/hints', key))
+                txn.delete(kv_key(base+'/allocated', 'format'))
+                for suffix in ('/assignments', '/hints', '/allocated'):
+                    cache = self._caches.get(base+suffix)
+                    if cache is not None: cache.clear()
+            return report
+        if dry_run:
+            with self.transaction(write=False) as txn:
+                return sweep(txn)
+        return self.run_transaction(sweep)
+
+    def _invalidate_caches(self, txnid):
+        for cache in self._caches.values():
+            cache.clear()
+        self._known_txnid = txnid
+
+    def _check_snapshot(self, txnid):
+        # Called with the id of a read transaction, which is the last
+        # transaction committed when it began.  Returns True if the
+        # caches can be used within it, emptying them first if another
+        # process has written since we last checked.
+        if txnid == self._known_txnid:
+            return True
+        if txnid > self._known_txnid:
+            self._invalidate_caches(txnid)
+            return True
+        # Older than what the caches reflect
+        return False
+
+    def _begin(self, write=False):
+        # Used by KvDomain.  Like transaction(), but cheaper since it
+        # does not set up a joinable transaction of its own.
+        txn = getattr(self._local, 'txn', None)
+        if txn is None:
+            if write:
+                return self.transaction(write=True)
+            return self._environment_begin(False)
+        if write and not self._local.write:
+            raise RuntimeError('Cannot start a write transaction within a read-only transaction')
+        return _JoinedTransaction(txn)
+
+    def domain(self, d:str, include_in_dump, *, cache_size=0):
         '''Return a :class:`KvDomain` for accessing a domain of keys in the Store.  Typical usage::
 
             kvstore = KvStore(path)
@@ -72,63 +299,228 @@ class KvStore(Injectable):
             domain.put('30', 'foo.com')   # foo.com is address 30 on this network
 
         :param include_in_dump: If True, then the contents of this domain should be included in the results of a call to :meth:`dump`
+
+        :param cache_size: If nonzero, :meth:`KvDomain.get` is served from an in-process LRU cache of up to this many keys, shared by every :class:`KvDomain` for *d* from this store.  Writes through this store update the cache; any write by another process empties it.
         '''
         if include_in_dump:
-            with self.environment.begin(write=True) as txn:
-                assert txn.put(b'dump:'+bytes(d, 'utf-8'), b'true', True)
+            self.run_transaction(lambda txn: txn.put(b'dump:'+bytes(d, 'utf-8'), b'true', True))
+        if cache_size:
+            cache = self._caches.get(d)
+            if cache is None:
+                cache = self._caches[d] = KvCache(cache_size)
+            else:
+                cache.size = max(cache.size, cache_size)
         return KvDomain(self, d)
 
-    def dump(self, file, filter):
-        domains = set()
-        file = Path(file)
-        result = dict()
-        with self.environment.begin() as txn, txn.cursor() as csr:
-            csr.set_range(b'dump')
+    def cache_stats(self):
+        '''
+        :returns: A dict mapping domains with caching enabled to their :class:`KvCache`.
+        '''
+        return dict(self._caches)
+
+    def _dump_entries(self, txn, filter):
+        # Yields (domain, key, value) for every entry in a dumpable domain that passes filter
+        domains = []
+        with txn.cursor() as csr:
+            csr.set_range(b'dump:')
             for key, value in csr:
                 if not key.startswith(b'dump:'): break
-                domains.add(key[5:])
-            for d in domains:
-                domain_key = d+b':'
-                csr.set_range(domain_key)
-                domain_result = dict()
+                domains.append(str(key[5:], 'utf-8'))
+        for d in domains:
+            domain_key = kv_key(d, '')
+            with txn.cursor() as csr:
+                if not csr.set_range(domain_key): continue
                 for key, value in csr:
-                    if not key.startswith(domain_key): continue
-                    key = key[len(domain_key):]
-                    key_str = str(key, 'utf-8')
+                    if not key.startswith(domain_key): break
+                    key_str = str(key[len(domain_key):], 'utf-8')
                     value_str = str(value, 'utf-8')
-                    if filter(str(d, 'utf-8'), key_str, value_str):
-                        domain_result[key_str] = value_str
-                result[str(d, 'utf-8')] = domain_result
-        file.write_text(yaml.dump(result, default_flow_style=False))
+                    if filter(d, key_str, value_str):
+                        yield d, key_str, value_str
+
+    def dump(self, file, filter):
+        '''Write the dumpable domains to *file* as a YAML mapping of domain to a mapping of keys to values.  *filter* is called with domain, key and value; only entries for which it returns True are dumped.  See :meth:`export` for a format that is much faster for large stores.
+        '''
+        file = Path(file)
+        result = dict()
+        with self.transaction(write=False) as txn:
+            for d, k, v in self._dump_entries(txn, filter):
+                result.setdefault(d, {})[k] = v
+        file.write_text(yaml.dump(result, default_flow_style=False, Dumper=_yaml_dumper))
+
+    def export(self, file, filter, *, differential=False):
+        '''Like :meth:`dump`, but written as it is read, in a line-oriented JSON format that :meth:`load` also accepts.  After a header line, each line is a JSON array of ``[domain, key, value]``.  A *value* of null records that an entry in an earlier line is no longer present.  When a key appears more than once, the last line wins.  Versions of Carthage before this format was introduced cannot load it.
+
+        :param differential: If True and *file* is already in this format, append only the entries that differ from what *file* already records, rather than rewriting it.  Once superseded lines would outnumber the live entries, the whole file is rewritten instead so that it does not grow without bound.  If *file* is not in this format, the whole file is written.
+
+        :returns: The number of entries written.
+        '''
+        file = Path(file)
+        if differential and _is_stream_dump(file):
+            previous = {}
+            lines = 0
+            for entry, v in _read_stream_dump(file):
+                previous[entry] = v
+                lines += 1
+            changes = []
+            live = 0
+            with self.transaction(write=False) as txn:
+                for d, k, v in self._dump_entries(txn, filter):
+                    live += 1
+                    if previous.pop((d, k), None) != v:
+                        changes.append([d, k, v])
+            for (d, k), v in previous.items():
+                if v is not None:
+                    changes.append([d, k, None])
+            if lines+len(changes) <= 2*live:
+                with file.open('at') as f:
+                    for entry in changes:
+                        f.write(json.dumps(entry)+'\n')
+                return len(changes)
+        count = 0
+        tmp = file.with_name(file.name+'.tmp')
+        with self.transaction(write=False) as txn, tmp.open('wt') as f:
+            f.write(_stream_dump_header+'\n')
+            for entry in self._dump_entries(txn, filter):
+                f.write(json.dumps(entry)+'\n')
+                count += 1
+        os.replace(tmp, file)
+        return count
 
     def load(self, file):
-        '''Load a dump file produced by :meth:`dump`.  Values aready in the :class:`KvStore` override values in the dump.
+        '''Load a dump file produced by :meth:`dump` or :meth:`export`.  Values aready in the :class:`KvStore` override values in the dump.
 
         The intent is that a dump file can be checked into a layout repository as an initial set of assignments for things like IP addresses and MAC addresses.  An actual running state_dir for the layout may diverge from the initial hints contained in the dump.  Periodically the layout repository can be updated.
         '''
         file = Path(file)
-        result = yaml.safe_load(file.read_text())
-        with self.environment.begin(write=True) as txn:
+        # Written directly rather than through KvDomain
+        for cache in self._caches.values(): cache.clear()
+        if _is_stream_dump(file):
+            # Keys written by this load; later lines for them replace earlier ones
+            def load_stream(txn):
+                loaded = set()
+                for (domain, k), v in _read_stream_dump(file):
+                    key = kv_key(domain, k)
+                    if key in loaded:
+                        if v is None:
+                            txn.delete(key)
+                            loaded.discard(key)
+                        else: txn.put(key, bytes(v, 'utf-8'))
+                    elif v is not None and txn.put(key, bytes(v, 'utf-8'), overwrite=False):
+                        loaded.add(key)
+            self.run_transaction(load_stream)
+            return
+        with file.open('rt') as f:
+            result = yaml.load(f, Loader=_yaml_loader)
+        def load_yaml(txn):
             for domain, domain_dict in result.items():
                 for k,v in domain_dict.items():
                     txn.put(kv_key(domain, k), bytes(v, 'utf-8'))
                     # Does not overwrite existing values
-                    
-    
+        self.run_transaction(load_yaml)
+
+
+_yaml_loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+_yaml_dumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+_stream_dump_header = json.dumps({'carthage-kvstore-dump': 1})
+
+def _is_stream_dump(file):
+    try:
+        with file.open('rt') as f:
+            return f.readline().rstrip('\n') == _stream_dump_header
+    except FileNotFoundError:
+        return False
+
+def _read_stream_dump(file):
+    # Yields ((domain, key), value) for each entry line
+    with file.open('rt') as f:
+        f.readline()
+        for line in f:
+            if not line.strip(): continue
+            d, k, v = json.loads(line)
+            yield (d, k), v
 
 __all__ += ['KvStore']
 
+
+class _JoinedTransaction:
+
+    # Context manager for an operation joining an existing transaction;
+    # commit or abort is up to the owner of the transaction.
+
+    __slots__ = ('txn',)
+
+    def __init__(self, txn):
+        self.txn = txn
+
+    def __enter__(self):
+        return self.txn
+
+    def __exit__(self, *args):
+        return False
+
+
 def kv_key(domain, key):
     domain = domain.replace(':', '::')
     return bytes(domain+':'+key, 'utf-8')
 
+def _key_domain(key: bytes):
+    # Inverse of the domain part of kv_key
+    i = 0
+    while True:
+        i = key.find(b':', i)
+        if i < 0: return str(key, 'utf-8')
+        if key[i+1:i+2] != b':':
+            return str(key[:i], 'utf-8').replace('::', ':')
+        i += 2
+
+
+class KvCache:
+
+    '''A bounded LRU cache of values in one domain of a :class:`KvStore`.  See the *cache_size* parameter of :meth:`KvStore.domain`.
+    '''
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        #: Lookups answered from the cache
+        self.hits = 0
+        #: Lookups that needed to read the store
+        self.misses = 0
+
+    def lookup(self, k):
+        # Raises KeyError on a miss; NotPresent is cached for missing keys
+        v = self.entries[k]
+        self.entries.move_to_end(k)
+        self.hits += 1
+        return v
+
+    def store(self, k, v):
+        self.entries[k] = v
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+    def __repr__(self):
+        return f'<KvCache {len(self.entries)}/{self.size} entries, {self.hits} hits, {self.misses} misses>'
+
+
+__all__ += ['KvCache']
+
 
 class KvDomain:
 
     def __init__(self, store, domain):
         self.domain = domain
+        self.store = store
         self.environment = store.environment
 
+    @property
+    def cache(self):
+        '''The :class:`KvCache` for this domain if caching is enabled'''
+        return self.store._caches.get(self.domain)
+
     def put(self, k, v, *,
             value=None,
             overwrite=False):
@@ -140,38 +532,79 @@ class KvDomain:
         if value:
             value_bytes = bytes(value, 'utf-8')
         else: value_bytes = None
-        with self.environment.begin(write=True) as txn:
+        def do_put(txn):
             if value_bytes:
                 actual_value = txn.get(key)
                 if actual_value != value_bytes:
                     raise KvConsistency(f'Expecting {k} == {value} but actually {value_bytes}')
             if not txn.put(key, v_bytes, overwrite=(overwrite or value is not None)):
                 raise KvConsistency(f'{k} present in {self.domain}')
-            
+            cache = self.cache
+            if cache is not None:
+                self._cache_store(cache, k, v)
+        self.store.run_transaction(do_put)
 
     def get(self, k, default=None):
-        '''Returns self[*k*] or if not present *default*'''
-        key = kv_key(self.domain, k)
-        with self.environment.begin() as txn:
-            v = txn.get(key, NotPresent)
-            if v == NotPresent: return default
-            return str(v, 'utf-8')
+        '''Returns self[*k*] or if not present *default*.  If the domain is cached, whether the cache is current is checked once per transaction; outside a :meth:`KvStore.transaction`, each call is its own transaction.'''
+        store = self.store
+        cache = store._caches.get(self.domain)
+        txn = getattr(store._local, 'txn', None)
+        if txn is not None:
+            # Join the enclosing transaction
+            if cache is not None and store._local.cache_valid:
+                v = self._cached_get(cache, txn, k)
+            else:
+                v = self._read(txn, k)
+        else:
+            with store._environment_begin(False) as txn:
+                if cache is not None and store._check_snapshot(txn.id()):
+                    v = self._cached_get(cache, txn, k)
+                else:
+                    v = self._read(txn, k)
+        if v is NotPresent: return default
+        return v
+
+    def _read(self, txn, k):
+        v = txn.get(kv_key(self.domain, k), NotPresent)
+        if v is NotPresent: return v
+        return str(v, 'utf-8')
+
+    def _cached_get(self, cache, txn, k):
+        try:
+            return cache.lookup(k)
+        except KeyError:
+            v = self._read(txn, k)
+            cache.misses += 1
+            self._cache_store(cache, k, v)
+            return v
+
+    def _cache_store(self, cache, k, v):
+        # Within a write transaction, note that cache may need to be
+        # cleared if the transaction aborts.
+        cache.store(k, v)
+        written = getattr(self.store._local, 'written', None)
+        if written is not None:
+            written.add(cache)
 
     def delete(self, k, value=NotPresent):
         '''Removes *k* from self or raises :class:`KvConsistency`
         If *value* is given, then self[*k*] must equal *value* before the delete.
 '''
         key = kv_key(self.domain, k)
-        with self.environment.begin(write=True) as txn, \
-             txn.cursor() as csr:
-            csr.set_key(key)
-            if csr.key() != key:
-                raise KvConsistency(f'{k} not in {self.domain}')
-            if value is not NotPresent:
-                value_bytes = bytes(value, 'utf-8')
-                if csr.value() != value_bytes:
-                    raise KvConsistency(f'{k} in {self.domain} had unexpected value')
-            csr.delete()
+        def do_delete(txn):
+            with txn.cursor() as csr:
+                csr.set_key(key)
+                if csr.key() != key:
+                    raise KvConsistency(f'{k} not in {self.domain}')
+                if value is not NotPresent:
+                    value_bytes = bytes(value, 'utf-8')
+                    if csr.value() != value_bytes:
+                        raise KvConsistency(f'{k} in {self.domain} had unexpected value')
+                csr.delete()
+            cache = self.cache
+            if cache is not None:
+                self._cache_store(cache, k, NotPresent)
+        self.store.run_transaction(do_delete)
 
 
     def __getitem__(self, k):
@@ -184,7 +617,46 @@ class KvDomain:
         try: self.delete(k)
         except KvConsistency:
             raise KeyError(k) from None
-        
+
+    def items(self, prefix=''):
+        '''Iterate over (key, value) pairs in this domain, or only those whose key starts with *prefix*.  The iteration happens within a single transaction, joining :meth:`KvStore.transaction` if active.
+        '''
+        domain_prefix = kv_key(self.domain, '')
+        range_prefix = kv_key(self.domain, prefix)
+        with self.store._begin() as txn, txn.cursor() as csr:
+            if not csr.set_range(range_prefix): return
+            for key, value in csr:
+                if not key.startswith(range_prefix): break
+                yield str(key[len(domain_prefix):], 'utf-8'), str(value, 'utf-8')
+
+    def prefetch(self, prefix, keys=()):
+        '''
+        Read every key in this domain starting with *prefix* in one cursor pass.  If the domain is cached, the values are loaded into the cache, and any of *keys* that are not present are cached as absent, so later :meth:`get` calls for them do not touch the store.
+
+        :returns: A dict of the keys found and their values.
+        '''
+        domain_prefix = kv_key(self.domain, '')
+        range_prefix = kv_key(self.domain, prefix)
+        result = {}
+        store = self.store
+        joined = getattr(store._local, 'txn', None) is not None
+        with store._begin() as txn, txn.cursor() as csr:
+            if joined:
+                cache_valid = store._local.cache_valid
+            else:
+                cache_valid = store._check_snapshot(txn.id())
+            if csr.set_range(range_prefix):
+                for key, value in csr:
+                    if not key.startswith(range_prefix): break
+                    result[str(key[len(domain_prefix):], 'utf-8')] = str(value, 'utf-8')
+        cache = self.cache
+        if cache is not None and cache_valid:
+            for k, v in result.items():
+                self._cache_store(cache, k, v)
+            for k in keys:
+                if k not in result: self._cache_store(cache, k, NotPresent)
+        return result
+
 
 class KvConsistency(RuntimeError):
 #    def __init__(self, *args):
@@ -209,12 +681,26 @@ class HintedAssignments(Injectable):
     #: How many times to retry an assignment when we lose a race against another process.
     consistency_retries = 5
 
+    #: Seconds to wait before the first retry; the wait doubles with each further retry (up to :attr:`retry_backoff_max`) and is jittered so that contending processes spread out.  Only used when the assignment is not part of an enclosing :meth:`KvStore.transaction`, since waiting would hold the write lock.  The wait is a :func:`time.sleep` and so blocks the calling thread, including an event loop running there; keep it short.
+    retry_backoff = 0.002
+
+    #: Upper bound in seconds on any single retry wait.
+    retry_backoff_max = 0.02
+
+    #: Size of the read caches for the assignments and hints; see :meth:`KvStore.domain`
+    cache_size = 16384
+
     def __init__(self, domain, **kwargs):
         super().__init__(**kwargs)
-        self._assignments = self.store.domain(domain+'/assignments', False)
-        self._hints = self.store.domain(domain+'/hints', True)
+        self._assignments = self.store.domain(domain+'/assignments', False, cache_size=self.cache_size)
+        self._hints = self.store.domain(domain+'/hints', True, cache_size=self.cache_size)
         self._can_validate_assignments = False
         self.prefer_reallocate = False #: move things around when the preferred assignment changes
+        self._domain = domain
+        #: Number of assignment attempts that raised :class:`KvConsistency`
+        self.conflicts = 0
+        #: Number of assignment attempts that were retried
+        self.retries = 0
         self.new_assignments()
 
 
@@ -229,35 +715,59 @@ Called in subclasses to indicate that an assignment should be made.  :meth:`reco
         :param key: The key under which an assignment or hint is registered.  Should be unique across runs for the same object.
 
         :param obj: The object corresponding to *key*.  Not used by :class:`HintedAssignments` except as an input to the subclass's :meth:`record_assignment`
+
+        Each attempt runs in one LMDB write transaction, which excludes writers in other processes sharing the store, so concurrent assigners do not ordinarily conflict.  To reserve a batch of assignments at once, make them within a single :meth:`KvStore.transaction`.  If an attempt does raise :class:`KvConsistency`, it is retried after a jittered backoff (see :attr:`retry_backoff`) up to :attr:`consistency_retries` times.  The backoff sleeps in the calling thread, so worst case an assignment blocks an event loop for :attr:`consistency_retries` times :attr:`retry_backoff_max`.  :attr:`conflicts` and :attr:`retries` count these on this object, and the totals are also recorded in the store for :meth:`KvStore.stats`.
         '''
-        for i in range(self.consistency_retries):
-            try:
-                hint = self._hints.get(key)
-                if hint and self.valid_assignment(hint, obj):
-                    # We always try to reuse a hint
-                    if self._try_assignment(key, obj, hint, True):
-                        return
-                    else:
-                        try: self._hints.delete(key, value=hint)
-                        except KvConsistency:
-                            logger.debug(f'Tried deleting hint for {key} but it was not {hint}')
-                # No hint
-                reusable_assignment = None
-                for assignment in self.possible_assignments(key, obj):
-                    result = self._try_assignment(key, obj, assignment, self.prefer_reallocate)
-                    if result is True: return
-                    if result == "reusable":
-                        # If we preferred reusing an assignment, then we already would have done so.
-                        # Remember the first reusable assignment and use if all assignments are exhausted.
-                        if reusable_assignment is None: reusable_assignment = assignment
-                if reusable_assignment:
-                    if self._try_assignment(key, obj, reusable_assignment, True):
-                        return
-                raise AssignmentsExhausted(f'Assignments for {self} exhausted')
-                
-            except KvConsistency:
-                continue
-        raise KvConsistency(f'Exceeded maximum retries')
+        conflicts = retries = 0
+        try:
+            for i in range(self.consistency_retries):
+                if i:
+                    retries += 1
+                    self.retries += 1
+                    if getattr(self.store._local, 'txn', None) is None and self.retry_backoff:
+                        time.sleep(random.uniform(0, min(
+                            self.retry_backoff * 2**(i-1), self.retry_backoff_max)))
+                try:
+                    # Joins an enclosing KvStore.transaction if there is one.
+                    return self.store.run_transaction(lambda txn: self._assign_once(key, obj))
+                except KvConsistency as e:
+                    conflicts += 1
+                    self.conflicts += 1
+                    logger.debug(f'Conflict assigning {key} in {self}: {e}')
+        finally:
+            if conflicts:
+                self.store._record_contention(self._domain, conflicts, retries)
+        raise KvConsistency(f'Exceeded maximum retries assigning {key} ({self.conflicts} conflicts, {self.retries} retries)')
+
+    def _assign_once(self, key, obj):
+        hint = self._hints.get(key)
+        if hint and self.valid_assignment(hint, obj):
+            # We always try to reuse a hint
+            if self._try_assignment(key, obj, hint, True):
+                return
+            else:
+                try: self._hints.delete(key, value=hint)
+                except KvConsistency:
+                    logger.debug(f'Tried deleting hint for {key} but it was not {hint}')
+        elif hint and self._assignments.get(hint) == key:
+            # key is moving out of an assignment that is no longer
+            # valid for it; nothing else can use that assignment until
+            # it is released.
+            self._assignments.delete(hint, value=key)
+            self._released(hint)
+        # No hint
+        reusable_assignment = None
+        for assignment in self.possible_assignments(key, obj):
+            result = self._try_assignment(key, obj, assignment, self.prefer_reallocate)
+            if result is True: return
+            if result == "reusable":
+                # If we preferred reusing an assignment, then we already would have done so.
+                # Remember the first reusable assignment and use if all assignments are exhausted.
+                if reusable_assignment is None: reusable_assignment = assignment
+        if reusable_assignment:
+            if self._try_assignment(key, obj, reusable_assignment, True):
+                return
+        raise AssignmentsExhausted(f'Assignments for {self} exhausted')
 
 
     def _try_assignment(self, key, obj, assignment, reallocate_assigned):
@@ -309,6 +819,11 @@ Called in subclasses to indicate that an assignment should be made.  :meth:`reco
         self._assignments_made[key] = str(assignment)
         return True
 
+    def _released(self, assignment):
+        # Called within the assignment transaction when *assignment*
+        # stops being recorded as assigned.
+        pass
+
     def force_assignment(self, key, obj, assignment):
         '''Force recording within the data store that *obj* identified by *key* has *assignment* as its assignment.  This is intended for dealing with statically assigned assignments that fall into the range that is automatically managed.  Does not call :meth:`record_assignment`
         '''
@@ -354,12 +869,211 @@ It is best if this generator yields strings; ass discussed in the documentation
 __all__ += ['HintedAssignments']
 
 
+class AllocationBitmap:
+
+    '''
+    A persistent bitmap of allocated integer slots stored in a :class:`KvDomain`.  Slots are grouped into blocks of :attr:`block_bits`; each block is stored as a hex string under its block number.  A second level bitmap (stored under ``s`` followed by a number) records which blocks are full.  Finding the nearest free slot reads at most a couple of blocks from each level rather than examining each allocated slot.
+    '''
+
+    block_bits = 4096
+    #: Bumped if the stored representation changes; a bitmap without the current version is rebuilt
+    format_version = '1'
+
+    def __init__(self, domain: KvDomain):
+        self.domain = domain
+        self._full = (1 << self.block_bits)-1
+
+    def _get(self, k):
+        v = self.domain.get(k)
+        return int(v, 16) if v else 0
+
+    def _put(self, k, bits):
+        self.domain.put(k, format(bits, 'x'), overwrite=True)
+
+    def _block(self, b):
+        return self._get(str(b))
+
+    def _put_block(self, b, bits, old_bits):
+        self._put(str(b), bits)
+        if (bits == self._full) != (old_bits == self._full):
+            sb, sbit = divmod(b, self.block_bits)
+            summary = self._get(f's{sb}')
+            summary ^= 1 << sbit
+            self._put(f's{sb}', summary)
+
+    def valid(self):
+        return self.domain.get('format') == self.format_version
+
+    def rebuild(self, slots):
+        '''Replace the contents of the bitmap with *slots*.'''
+        blocks = {}
+        for i in slots:
+            b, bit = divmod(i, self.block_bits)
+            blocks[b] = blocks.get(b, 0) | (1 << bit)
+        def rebuild(txn):
+            for k, v in list(self.domain.items()):
+                self.domain.delete(k)
+            for b, bits in blocks.items():
+                self._put_block(b, bits, 0)
+            self.domain.put('format', self.format_version, overwrite=True)
+        self.domain.store.run_transaction(rebuild)
+
+    def __contains__(self, i):
+        b, bit = divmod(i, self.block_bits)
+        return bool(self._block(b) & (1 << bit))
+
+    def set(self, i, allocated=True):
+        b, bit = divmod(i, self.block_bits)
+        bits = self._block(b)
+        new_bits = bits | (1 << bit) if allocated else bits & ~(1 << bit)
+        if new_bits != bits:
+            self._put_block(b, new_bits, bits)
+
+    def _next_open_block(self, b, limit):
+        # Lowest block >= b that is not full, or None if beyond limit
+        sb, sbit = divmod(b, self.block_bits)
+        while sb*self.block_bits <= limit:
+            open_blocks = ~self._get(f's{sb}') & self._full & ~((1 << sbit)-1)
+            if open_blocks:
+                b = sb*self.block_bits + (open_blocks & -open_blocks).bit_length()-1
+                return b if b <= limit else None
+            sb += 1
+            sbit = 0
+        return None
+
+    def _prev_open_block(self, b, limit):
+        # Highest block <= b that is not full, or None if below limit
+        sb, sbit = divmod(b, self.block_bits)
+        while (sb+1)*self.block_bits > limit and sb >= 0:
+            open_blocks = ~self._get(f's{sb}') & ((1 << (sbit+1))-1)
+            if open_blocks:
+                b = sb*self.block_bits + open_blocks.bit_length()-1
+                return b if b >= limit else None
+            sb -= 1
+            sbit = self.block_bits-1
+        return None
+
+    def next_free(self, i, high):
+        '''Lowest free slot *n* with i <= n <= high, or None.'''
+        b, bit = divmod(i, self.block_bits)
+        high_block = high // self.block_bits
+        while True:
+            free = ~self._block(b) & self._full & ~((1 << bit)-1)
+            if free:
+                n = b*self.block_bits + (free & -free).bit_length()-1
+                return n if n <= high else None
+            b = self._next_open_block(b+1, high_block)
+            if b is None: return None
+            bit = 0
+
+    def prev_free(self, i, low):
+        '''Highest free slot *n* with low <= n <= i, or None.'''
+        b, bit = divmod(i, self.block_bits)
+        low_block = low // self.block_bits
+        while True:
+            free = ~self._block(b) & ((1 << (bit+1))-1)
+            if free:
+                n = b*self.block_bits + free.bit_length()-1
+                return n if n >= low else None
+            if b == 0: return None
+            b = self._prev_open_block(b-1, low_block)
+            if b is None: return None
+            bit = self.block_bits-1
+
+    def nearest_free(self, hash, low, high):
+        '''The free slot closest to *hash* within [*low*, *high*], preferring the higher slot on a tie.  This is the first free slot in the order :meth:`HashedRangeAssignments.possible_assignments` yields.
+        '''
+        up = self.next_free(hash, high)
+        down = self.prev_free(hash, low)
+        if up is None: return down
+        if down is None: return up
+        return up if up-hash <= hash-down else down
+
+
+__all__ += ['AllocationBitmap']
+
+
+def sum_key_hash(key: str) -> int:
+    '''The sum of the code points in *key*.  This was the only hash Carthage used before :data:`key_hash_strategies` existed.  It clusters badly: ``web1|eth0`` and ``web2|eth0`` hash to neighbouring values, and anagrams collide.
+    '''
+    result = 0
+    for c in key: result += ord(c)
+    return result
+
+def blake2b_key_hash(key: str) -> int:
+    '''A uniformly distributed hash of *key* that is stable across runs and Python versions.'''
+    return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'big')
+
+#: Map of strategy name to a function from a key string to a non-negative integer.  See :attr:`HashedRangeAssignments.hash_strategy`.
+key_hash_strategies = dict(
+    sum=sum_key_hash,
+    blake2b=blake2b_key_hash,
+)
+
+__all__ += ['sum_key_hash', 'blake2b_key_hash', 'key_hash_strategies']
+
+
 class HashedRangeAssignments(HintedAssignments):
 
+    '''
+    Assignments from a range of integer-like values (integers or objects such as :class:`~ipaddress.IPv4Address` that support ``int()`` and addition of integers).  Each key prefers the slot given by :meth:`hash_key`, and otherwise the nearest available slot.
+
+    An :class:`AllocationBitmap` of assigned slots is kept alongside the assignments so that finding the nearest free slot does not require probing each occupied slot in turn.  The bitmap is only an accelerator: a slot it reports free is still checked against the assignments.  Once no free slot remains, or when :attr:`prefer_reallocate` is set, every slot is probed so that reusable assignments are found.
+    '''
+
+    #: The name of a strategy in :data:`key_hash_strategies` used by :meth:`hash_key`.  If None, the strategy recorded for the domain is used.  A domain with no recorded strategy records ``sum`` if it already has hints (so existing hint databases keep assigning new keys the way they always have) and :attr:`default_hash_strategy` otherwise.
+    hash_strategy = None
+    default_hash_strategy = 'blake2b'
+
     def __init__(self, domain,  **kwargs):
         super().__init__(domain, **kwargs)
+        self._allocated = AllocationBitmap(self.store.domain(domain+'/allocated', False, cache_size=256))
+        # Included in dumps so that a seeded state directory hashes the same way
+        self._settings = self.store.domain(domain+'/settings', True)
+        self._key_hash = None
+
+    def _find_key_hash(self):
+        strategy = self.hash_strategy
+        if strategy is None:
+            with self.store.transaction():
+                strategy = self._settings.get('hash_strategy')
+                if strategy is None:
+                    if next(iter(self._hints.items()), None):
+                        strategy = 'sum'
+                    else:
+                        strategy = self.default_hash_strategy
+                    self._settings.put('hash_strategy', strategy, overwrite=True)
+        try:
+            return key_hash_strategies[strategy]
+        except KeyError:
+            raise ValueError(f'Unknown hash strategy {strategy} for {self}') from None
+
+    def _allocation_index(self):
+        # Checked every time (a cached read) because the bitmap may be
+        # invalidated by another process or by
+        # KvStore.sweep_assignments.
+        if not self._allocated.valid():
+            slots = []
+            for assignment, key in self._assignments.items():
+                try: slots.append(int(self.str_to_assignment(assignment)))
+                except (ValueError, TypeError): pass
+            self._allocated.rebuild(slots)
+        return self._allocated
+
+    def _released(self, assignment):
+        super()._released(assignment)
+        try: slot = int(self.str_to_assignment(str(assignment)))
+        except (ValueError, TypeError): return
+        self._allocation_index().set(slot, False)
+
+    def _try_assignment(self, key, obj, assignment, reallocate_assigned):
+        result = super()._try_assignment(key, obj, assignment, reallocate_assigned)
+        # Whether we took the slot or found it taken, it is now allocated
+        try: slot = int(self.str_to_assignment(str(assignment)))
+        except (ValueError, TypeError): return result
+        self._allocation_index().set(slot)
+        return result
 
-    
 
     def hash_key(self, key, obj):
         '''Key hashed, bounded to low <= key <= high
@@ -367,8 +1081,9 @@ class HashedRangeAssignments(HintedAssignments):
 '''
         assert isinstance(key, str)
         low, high = self.find_bounds(obj)
-        result = 0
-        for c in key: result += ord(c)
+        if self._key_hash is None:
+            self._key_hash = self._find_key_hash()
+        result = self._key_hash(key)
         try: size = high-low +1
         except TypeError:
             size = int(high)-int(low)+1
@@ -388,6 +1103,17 @@ class HashedRangeAssignments(HintedAssignments):
         '''
         low, high = self.find_bounds(obj)
         low, hash, high = self.hash_key(key, obj)
+        if not self.prefer_reallocate:
+            # Visit free slots in the same order the probe below
+            # would.  A slot found to be taken is marked allocated by
+            # _try_assignment, so the next search moves past it.
+            index = self._allocation_index()
+            int_low, int_hash, int_high = int(low), int(hash), int(high)
+            while True:
+                slot = index.nearest_free(int_hash, int_low, int_high)
+                if slot is None: break
+                yield str(hash + (slot - int_hash))
+                index.set(slot)
         result_yielded = True
         distance = 0
         while result_yielded:
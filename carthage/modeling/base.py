@@ -17,6 +17,7 @@ from .decorators import *
 from carthage.dependency_injection import *  # type: ignore
 from carthage.utils import when_needed, memoproperty
 from carthage import ConfigLayout, SetupTaskMixin
+from carthage.setup_tasks import setup_task_memo
 import carthage.kvstore
 import carthage.network
 import carthage.machine
@@ -59,6 +60,7 @@ class InjectableModel(Injectable, metaclass=InjectableModelType):
         # once so that instantiations alias and we don't accidentally
         # get multiple instances of the same type providing related
         # but different keys.
+        to_register: typing.Dict[InjectionKey, DependencyProvider] = {}
         for k, info in self.__class__.__initial_injections__.items():
             v, options = info
             if k in ignored_keys: continue
@@ -73,11 +75,13 @@ class InjectableModel(Injectable, metaclass=InjectableModelType):
                     dependency_providers[v] = dp
                 except TypeError:
                     pass
-            options = dict(options)
-            try:
-                self.injector.add_provider(k, dp, replace=True, **options)
-            except Exception as e:
-                raise RuntimeError(f'Failed registering {v} as provider for {k}') from e
+            to_register[k] = dp
+        try:
+            self.injector.add_providers(to_register, replace=True)
+        except Exception as e:
+            if hasattr(e, 'injection_key'):
+                raise RuntimeError(f'Failed registering {e.provider} as provider for {e.injection_key}') from e
+            raise RuntimeError(f'Failed registering providers for {self.__class__.__name__}') from e
 
         for c in reversed(self.__class__.__mro__):
             if isinstance(c, ModelingBase) and hasattr(c, '_callbacks'):
@@ -194,12 +198,14 @@ class ModelGroup(InjectableModel, AsyncInjectable, metaclass=ModelingContainer):
         models = await self.resolve_networking()
         models += self.all_model_tasks
         futures = []
-        for m in models:
-            if not isinstance(m, AsyncInjectable):
-                continue
-            futures.append(asyncio.ensure_future(cb(m)))
-        if futures:
-            await asyncio.gather(*futures)
+        # Models often depend on the same tasks; check each only once
+        with setup_task_memo():
+            for m in models:
+                if not isinstance(m, AsyncInjectable):
+                    continue
+                futures.append(asyncio.ensure_future(cb(m)))
+            if futures:
+                await asyncio.gather(*futures)
         if hasattr(super(), 'generate'):
             await super().generate()
 
@@ -1026,14 +1026,21 @@ class V4Pool(carthage.kvstore.HashedRangeAssignments):
         return f'{link.machine.name}|{link.interface}'
 
     def assignment_loop(self, links):
-        for link in links:
-            bounds = self.find_bounds(link)
-            if not bounds: continue
-            key = self.link_key(link)
-            if link.v4_config and link.v4_config.address:
-                self.force_assignment(key, link, link.v4_config.address)
-            else:
-                self._assign(key, link)
+        assignments_made = dict(self._assignments_made)
+        def loop(txn):
+            # Forget assignments from an attempt that was rolled back
+            self._assignments_made = dict(assignments_made)
+            for link in links:
+                bounds = self.find_bounds(link)
+                if not bounds: continue
+                key = self.link_key(link)
+                if link.v4_config and link.v4_config.address:
+                    self.force_assignment(key, link, link.v4_config.address)
+                else:
+                    self._assign(key, link)
+        # One write transaction for the whole round rather than several per link
+        self.store.run_transaction(loop)
+
     def str_to_assignment(self, assignment):
         return IPv4Address(assignment)
     
@@ -41,7 +41,7 @@ class MacStore(Injectable):
         super().__init__(**kwargs)
         state_dir = Path(self.config_layout.state_dir)
         self.path = state_dir / "macs.yml"
-        self.domain = self.kvstore.domain('mac', True)
+        self.domain = self.kvstore.domain('mac', True, cache_size=1024)
         self.load()
         
 
@@ -56,7 +56,7 @@ class MacStore(Injectable):
         if self.path.exists():
             yaml_dict = yaml.safe_load(self.path.read_text())
             assert isinstance(yaml_dict, dict)
-            recurse(yaml_dict, tuple())
+            self.kvstore.run_transaction(lambda txn: recurse(yaml_dict, tuple()))
 
 
     def __getitem__(self, k):
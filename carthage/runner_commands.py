@@ -8,6 +8,7 @@
 
 from __future__ import annotations
 import argparse
+from pathlib import Path
 from .console import CarthageRunnerCommand
 from . import *
 from . import kvstore
@@ -80,6 +81,10 @@ class DumpAssignmentsCommand(CarthageRunnerCommand):
                             default=self.persistent_seed_path,
                             nargs='?',
                             help=f'Path where assignments are dumped; defaults to {self.persistent_seed_path}')
+        parser.add_argument('--stream', action='store_true',
+                            help='Write the line-oriented format of KvStore.export, which later dumps append only changes to.  Files already in that format keep it.  Older Carthage cannot load it.')
+        parser.add_argument('--full', action='store_true',
+                            help='With the line-oriented format, rewrite the whole file rather than appending only changed assignments')
         
 
     async def run(self, args):
@@ -88,7 +93,10 @@ class DumpAssignmentsCommand(CarthageRunnerCommand):
         layout = await self.ainjector.get_instance_async(CarthageLayout)
         models = await layout.all_models(ready=False)
         self.model_names = set((m.name for m in models))
-        store.dump(args.path, self.dump_filter)
+        if args.stream or kvstore._is_stream_dump(Path(args.path)):
+            store.export(args.path, self.dump_filter, differential=not args.full)
+        else:
+            store.dump(args.path, self.dump_filter)
 
     def dump_filter(self, domain, key, value):
         # Several domains have keys of the form model|interface
@@ -101,9 +109,170 @@ class DumpAssignmentsCommand(CarthageRunnerCommand):
         return True
     
 
+class SweepAssignmentsCommand(CarthageRunnerCommand):
+
+    name = 'sweep_assignments'
+
+    subparser_kwargs = dict(
+        help='Release assignments such as IP addresses held by machines no longer in this layout',
+        )
+
+    def setup_subparser(self, parser):
+        parser.add_argument('--dry-run', '-n', action='store_true',
+                            help='Only report the assignments that would be released')
+
+    async def run(self, args):
+        from carthage.modeling import CarthageLayout
+        store = await self.ainjector.get_instance_async(kvstore.KvStore)
+        layout = await self.ainjector.get_instance_async(CarthageLayout)
+        models = await layout.all_models(ready=False)
+        self.model_names = set((m.name for m in models))
+        report = store.sweep_assignments(self.live_key, dry_run=args.dry_run)
+        verb = 'Would release' if args.dry_run else 'Released'
+        for domain, dead in sorted(report.items()):
+            for assignment, key in dead:
+                print(f'{verb} {domain} {assignment} from {key}')
+        print(f'{verb} {sum(len(d) for d in report.values())} assignments')
+
+    def live_key(self, domain, key):
+        # Same key structure as DumpAssignmentsCommand.dump_filter
+        name, sep, interface = key.partition('|')
+        if sep:
+            return name in self.model_names
+        return True
+
+
+class StoreStatsCommand(CarthageRunnerCommand):
+
+    name = 'store_stats'
+
+    subparser_kwargs = dict(
+        help='Show how much of the persistent assignment store is in use',
+        )
+
+    def setup_subparser(self, parser):
+        pass
+
+    async def run(self, args):
+        store = await self.ainjector.get_instance_async(kvstore.KvStore)
+        stats = store.stats()
+        print(f'{stats["path"]}:')
+        print(f'  map: {stats["bytes_used"]} of {stats["map_size"]} bytes used ({stats["map_used"]:.1%}); {stats["pages_used"]} pages of {stats["page_size"]} bytes')
+        print(f'  readers: {stats["readers_in_use"]} of {stats["max_readers"]} slots in use')
+        print(f'  entries: {stats["entries"]}')
+        for domain, count in sorted(stats['domains'].items()):
+            print(f'    {domain}: {count}')
+        if stats['contention']:
+            print('  assignment contention:')
+            for domain, counts in sorted(stats['contention'].items()):
+                print(f'    {domain}: {counts["conflicts"]} conflicts, {counts["retries"]} retries')
+
+
+class PlanCommand(CarthageRunnerCommand):
+
+    '''
+    Show which setup tasks generating the layout would run.  Models, the :class:`~carthage.machine.Machine` of each model with a machine implementation, and :class:`~carthage.modeling.ModelTasks` are checked.  Nothing is made ready and networking is not resolved, so no network assignments are written to the persistent store; tasks whose hash depends on resolved networking may therefore be reported as changed, and objects whose checks fail are listed as errors.
+    '''
+
+    name = 'plan'
+
+    subparser_kwargs = dict(
+        help='Show which setup tasks generating this layout would run, and how long they are expected to take; does not resolve networking or change the assignment store',
+        )
+
+    def setup_subparser(self, parser):
+        parser.add_argument('--json', action='store_true',
+                            help='Print the plan as JSON')
+
+    async def run(self, args):
+        import json
+        from carthage.modeling import CarthageLayout, ModelTasks
+        from carthage.setup_tasks import plan_setup_tasks
+        from carthage.task_history import task_history
+        layout = await self.ainjector.get_instance_async(InjectionKey(CarthageLayout, _ready=False))
+        models = await layout.all_models(ready=False)
+        objects = list(models)
+        errors = []
+        for model in models:
+            try:
+                model.machine_type
+            except KeyError:
+                continue  # no machine_implementation_key
+            try:
+                machine = await model.injector(AsyncInjector).get_instance_async(
+                    InjectionKey(Machine, _ready=False))
+            except Exception as e:
+                errors.append((model, e))
+                continue
+            objects.append(machine)
+        model_tasks = await layout.ainjector.filter_instantiate_async(
+            ModelTasks, ['name'], ready=False)
+        objects.extend(m[1] for m in model_tasks)
+        config = await self.ainjector.get_instance_async(ConfigLayout)
+        plan = await plan_setup_tasks(objects, history=task_history(config))
+        plan.errors.extend(errors)
+        if args.json:
+            print(json.dumps(plan.as_dict(), indent=2))
+        else:
+            print(plan.format())
+
+
+class StatsCommand(CarthageRunnerCommand):
+
+    name = 'stats'
+
+    subparser_kwargs = dict(
+        help='Summarize how long setup tasks have taken',
+        )
+
+    def setup_subparser(self, parser):
+        parser.add_argument('--top', type=int, default=10,
+                            help='How many of the slowest objects to show')
+        parser.add_argument('--json', action='store_true',
+                            help='Print the statistics as JSON')
+
+    async def run(self, args):
+        import json
+        from carthage.task_history import task_history
+        config = await self.ainjector.get_instance_async(ConfigLayout)
+        history = task_history(config)
+        runs = history.runs()
+        task_stats = history.task_stats()
+        slowest = history.slowest_objects(args.top)
+        regressions = history.regressions()
+        if args.json:
+            print(json.dumps(dict(
+                runs=len(runs),
+                records=len(history.records),
+                tasks=task_stats,
+                slowest_objects=slowest,
+                regressions=regressions), indent=2))
+            return
+
+        def duration(d):
+            return '-' if d is None else f'{d:.2f}s'
+        print(f'{len(history.records)} task executions in {len(runs)} runs from {history.path}')
+        if not task_stats: return
+        width = max(len(t) for t in task_stats)
+        print(f'{"task":<{width}}  {"runs":>6} {"failed":>6} {"p50":>9} {"p95":>9} {"total":>10}')
+        for stamp, stats in sorted(task_stats.items(), key=lambda t: t[1]['total'], reverse=True):
+            print(f'{stamp:<{width}}  {stats["runs"]:>6} {stats["failures"]:>6} {duration(stats["p50"]):>9} {duration(stats["p95"]):>9} {duration(stats["total"]):>10}')
+        print('Slowest objects:')
+        for obj, total in slowest:
+            print(f'    {obj}: {duration(total)}')
+        if regressions:
+            print('Slower in the latest run:')
+            for stamp, previous, current in regressions:
+                print(f'    {stamp}: {duration(previous)} -> {duration(current)}')
+
+
 def enable_runner_commands(ainjector):
     ainjector.add_provider(StartCommand)
     ainjector.add_provider(ListMachines)
     ainjector.add_provider(StopCommand)
     ainjector.add_provider(DumpAssignmentsCommand)
+    ainjector.add_provider(SweepAssignmentsCommand)
+    ainjector.add_provider(StoreStatsCommand)
+    ainjector.add_provider(PlanCommand)
+    ainjector.add_provider(StatsCommand)
 
@@ -9,6 +9,7 @@
 from __future__ import annotations
 import asyncio
 import contextlib
+import contextvars
 import dataclasses
 import datetime
 import logging
@@ -20,18 +21,27 @@ import sys
 import shutil
 import weakref
 import importlib.resources
+import hashlib
+import json
+import secrets
+import tempfile
 from pathlib import Path
 import carthage
-from carthage.dependency_injection import AsyncInjector, inject, BaseInstantiationContext
+from carthage.dependency_injection import AsyncInjector, Injectable, inject, inject_autokwargs, BaseInstantiationContext
 from carthage.dependency_injection.introspection import current_instantiation
 from carthage.config import ConfigLayout
+from carthage.kvstore import KvStore, KvConsistency
+from carthage.task_history import task_history
 from carthage.utils import memoproperty, import_resources_files
 import collections.abc
 
 __all__ = ['logger', 'TaskWrapper', 'TaskMethod', 'setup_task', 'SkipSetupTask', 'SetupTaskMixin',
            'cross_object_dependency',
            'mako_task',
-           "install_mako_task"]
+           "install_mako_task",
+           'KvStamps',
+           'SetupTaskMemo', 'setup_task_memo',
+           'PlannedTask', 'SetupTaskPlan', 'plan_setup_tasks', 'run_reasons']
 
 logger = logging.getLogger('carthage.setup_tasks')
 
@@ -79,6 +89,8 @@ class TaskWrapperBase:
     order: int = dataclasses.field(default_factory=_inc_task_order)
     invalidator_func = None
     check_completed_func = None
+    #: Tasks that must complete before this one when tasks are run as a graph; None means every earlier task.  See :func:`setup_task`.
+    requires: typing.Optional[tuple] = None
     hash_func: typing.Callable = staticmethod(lambda self: "")
 
     @memoproperty
@@ -94,6 +106,11 @@ class TaskWrapperBase:
         return TaskMethod(self, instance)
 
     def __call__(self, instance, *args, **kwargs):
+        memo = _active_memo()
+        if memo is not None:
+            # Whatever happens, earlier checks are out of date
+            memo.invalidate(instance, self)
+
         def success():
             if not self.check_completed_func:
                 hash_contents = instance.injector(self.hash_func, instance)
@@ -106,6 +123,8 @@ class TaskWrapperBase:
                 instance.delete_stamp(self.stamp)
 
         def final():
+            if memo is not None:
+                memo.invalidate(instance, self)
             context.done()
 
         def callback(fut):
@@ -172,36 +191,63 @@ class TaskWrapperBase:
         :param: obj
             The instance on which setup_tasks are being run.
 
+        Within a :func:`setup_task_memo`, the result is remembered until this task is next run on *obj*.
+
+        '''
+        should_run, last_run, reason = await self.explain_should_run(obj, dependency_last_run, ainjector=ainjector)
+        return should_run, last_run
+
+    async def explain_should_run(self, obj: SetupTaskMixin,
+                                 dependency_last_run: float = None,
+                                 *, ainjector: AsyncInjector):
+        '''
+        Like :meth:`should_run_task`, but also returns why the task should run.
+
+        :returns: A tuple of whether the task should run, when it was last run, and one of :data:`run_reasons` (None if the task should not run).
         '''
         if dependency_last_run is None:
             dependency_last_run = 0.0
+        memo = _active_memo()
+        if memo is not None:
+            return await memo._memoize(
+                obj, self, dependency_last_run,
+                lambda: self._should_run_task(obj, dependency_last_run, ainjector))
+        return await self._should_run_task(obj, dependency_last_run, ainjector)
+
+    async def _should_run_task(self, obj, dependency_last_run, ainjector):
         if self.check_completed_func:
             last_run = await ainjector(self.check_completed_func, obj)
             hash_contents = ""
             if last_run is True:
                 obj.logger_for().debug(f"Task {self.description} for {obj} run without providing timing information")
-                return (False, dependency_last_run)
+                return (False, dependency_last_run, None)
         else:
             last_run, hash_contents = obj.check_stamp(self.stamp)
-        if last_run is False:
+        if not last_run:
             obj.logger_for().debug(f"Task {self.description} never run for {obj}")
-            return (True, dependency_last_run)
+            return (True, dependency_last_run,
+                    'not completed' if self.check_completed_func else 'no stamp')
         if last_run < dependency_last_run:
             obj.logger_for().debug(
                 f"Task {self.description} last run {_iso_time(last_run)}, but dependency run more recently at {_iso_time(dependency_last_run)}")
-            return (True, dependency_last_run)
+            return (True, dependency_last_run, 'dependency newer')
         obj.logger_for().debug(f"Task {self.description} last run for {obj} at {_iso_time(last_run)}")
         if not self.check_completed_func:
-            actual_hash_contents = await ainjector(self.hash_func, obj)
+            memo = _active_memo()
+            if memo is not None:
+                actual_hash_contents = await memo._memoize(
+                    obj, self, 'hash', lambda: ainjector(self.hash_func, obj))
+            else:
+                actual_hash_contents = await ainjector(self.hash_func, obj)
             if actual_hash_contents != hash_contents:
                 obj.logger_for().debug(
                     f'Task {self.description} old_hash: `{hash_contents}`, new_hash: `{actual_hash_contents}`')
-                return (True, dependency_last_run)
+                return (True, dependency_last_run, 'hash changed')
         if self.invalidator_func:
             if not await ainjector(self.invalidator_func, obj, last_run=last_run):
                 obj.logger_for().info(f"Task {self.description} invalidated for {obj}; last run {_iso_time(last_run)}")
-                return (True, time.time())
-        return (False, last_run)
+                return (True, time.time(), 'invalidated')
+        return (False, last_run, None)
 
     def invalidator(self, slow=False):
         '''Decorator to indicate  an invalidation function for a :func:`setup_task`
@@ -297,7 +343,7 @@ class TaskWrapper(TaskWrapperBase):
     extra_attributes = frozenset()
 
     def __setattr__(self, a, v):
-        if a in ('func', 'stamp', 'order',
+        if a in ('func', 'stamp', 'order', 'requires',
                  'invalidator_func', 'check_completed_func', 'hash_func') or a in self.__class__.extra_attributes:
             return super().__setattr__(a, v)
         else:
@@ -326,7 +372,8 @@ class TaskMethod:
 
 def setup_task(description, *,
                order=None,
-               before=None):
+               before=None,
+               requires=None):
     '''Mark a method as a setup task.  Describe the task for logging.  Must be in a class that is a subclass of
     SetupTaskMixin.  Usage::
 
@@ -337,6 +384,8 @@ def setup_task(description, *,
 
     :param before: Run this task before the task referenced in *before*.
 
+    :param requires: A task or sequence of tasks that must complete before this task when the ``tasks.concurrency`` config option allows tasks to run in parallel.  If any of them run, this task's stamp is out of date just as if an earlier task had run when running serially.  The default of None requires every earlier task, which gives the same results as running serially; ``requires=()`` makes a task independent of all others.  This task is ordered after the tasks it requires.
+
     '''
     global _task_order
     if order and before:
@@ -347,15 +396,40 @@ def setup_task(description, *,
         _task_order = order
         _inc_task_order()
 
+    requires = _normalize_requires(requires)
+
     def wrap(fn):
         kws = {}
         if order:
             kws['order'] = order
         t = TaskWrapper(func=fn, description=description, **kws)
+        _set_requires(t, requires, order)
         return t
     return wrap
 
 
+def _normalize_requires(requires):
+    if isinstance(requires, TaskWrapperBase):
+        return (requires,)
+    elif requires is not None:
+        return tuple(requires)
+    return None
+
+
+def _set_requires(task, requires, order=None):
+    # Used by setup_task and SetupTaskMixin.add_setup_task.  Sets
+    # task.requires and orders task after the tasks it requires; if
+    # an explicit *order* does not allow that, it is an error.
+    requires = _normalize_requires(requires)
+    task.requires = requires
+    if requires:
+        latest = max(r.order for r in requires)
+        if task.order <= latest:
+            if order:
+                raise TypeError(f'{task.description} is ordered before a task it requires')
+            task.order = latest+1
+
+
 class SkipSetupTask(Exception):
     pass
 
@@ -373,7 +447,9 @@ class SetupTaskMixin:
                 raise RuntimeError('kwargs cannot be specified if task is a TaskWrapper')
         else:
             stamp = kwargs.pop('stamp', None)
+            requires = kwargs.pop('requires', None)
             task = TaskWrapper(func=task, **kwargs)
+            _set_requires(task, requires, kwargs.get('order'))
             if stamp:
                 task.stamp = stamp
         self.setup_tasks.append(task)
@@ -384,6 +460,8 @@ class SetupTaskMixin:
         is used as an asynchronous context manager that will be entered before the
         first task and eventually exited.  The context is never
         entered if no tasks are run.
+
+        Tasks normally run one at a time in order.  If the ``tasks.concurrency`` config option is greater than one, tasks are run as a graph (see the *requires* parameter to :func:`setup_task`) with up to that many tasks running at once.
         '''
         injector = getattr(self, 'injector', carthage.base_injector)
         ainjector = getattr(self, 'ainjector', None)
@@ -393,19 +471,34 @@ class SetupTaskMixin:
         if config is None:
             config = injector(ConfigLayout)
         context_entered = False
+        context_lock = asyncio.Lock()
         dry_run = config.tasks.dry_run
-        dependency_last_run = 0.0
-        for t in self.setup_tasks:
+        concurrency = config.tasks.concurrency
+        history = task_history(config)
+
+        async def run_task(t, dependency_last_run):
+            # Returns the dependency_last_run for tasks that depend on t
+            nonlocal context_entered
             should_run, dependency_last_run = await t.should_run_task(self, dependency_last_run, ainjector=ainjector)
             if should_run:
                 try:
-                    if (not context_entered) and context is not None:
-                        await context.__aenter__()
-                        context_entered = True
+                    async with context_lock:
+                        if (not context_entered) and context is not None:
+                            await context.__aenter__()
+                            context_entered = True
                     if not dry_run:
                         self.logger_for().info(f"Running {t.description} task for {self}")
-                        with SetupTaskContext(self, t):
-                            await ainjector(t, self)
+                        start = time.time()
+                        outcome = 'failure'
+                        try:
+                            with SetupTaskContext(self, t):
+                                await ainjector(t, self)
+                            outcome = 'success'
+                        except SkipSetupTask:
+                            outcome = 'skipped'
+                            raise
+                        finally:
+                            history.record(self, t, start, time.time(), outcome)
                         dependency_last_run = time.time()
                     else:
                         self.logger_for().info(f'Would run {t.description} task for {self}')
@@ -413,12 +506,60 @@ class SetupTaskMixin:
                     pass
                 except Exception:
                     self.logger_for().exception(f"Error running {t.description} for {self}:")
-                    if context_entered:
-                        await context.__aexit__(*sys.exc_info())
                     raise
+            return dependency_last_run
+
+        kv_stamps = _kv_stamps_for(self, injector, config)
+        if kv_stamps:
+            stamp_path = self.stamp_path
+            kv_stamps.prefetch(stamp_path, [t.stamp for t in self.setup_tasks])
+        renders = _pass_renders.set({})
+        try:
+            with setup_task_memo():
+                if concurrency > 1:
+                    await self._run_setup_task_graph(run_task, concurrency)
+                else:
+                    dependency_last_run = 0.0
+                    for t in self.setup_tasks:
+                        dependency_last_run = await run_task(t, dependency_last_run)
+        except Exception:
+            if context_entered:
+                await context.__aexit__(*sys.exc_info())
+            raise
+        finally:
+            _pass_renders.reset(renders)
+            if kv_stamps:
+                kv_stamps.release(stamp_path)
         if context_entered:
             await context.__aexit__(None, None, None)
 
+    async def _run_setup_task_graph(self, run_task, concurrency):
+        # Each task starts once the tasks it requires are done, and
+        # sees the latest dependency_last_run among them.  Once a
+        # task fails no more tasks are started, but tasks already
+        # running are allowed to finish.
+        predecessors = _task_predecessors(self, self.setup_tasks)
+        semaphore = asyncio.Semaphore(concurrency)
+        futures = {}
+        failed = False
+
+        async def run(t):
+            nonlocal failed
+            results = await asyncio.gather(*(futures[p] for p in predecessors[t.stamp]))
+            async with semaphore:
+                if failed: return None
+                try:
+                    return await run_task(t, max(results, default=0.0))
+                except BaseException:
+                    failed = True
+                    raise
+        for t in self.setup_tasks:
+            futures[t.stamp] = asyncio.ensure_future(run(t))
+        results = await asyncio.gather(*futures.values(), return_exceptions=True)
+        for r in results:
+            if isinstance(r, BaseException):
+                raise r
+
     def _class_setup_tasks(self):
         cls = self.__class__
         meth_names = {}
@@ -441,6 +582,9 @@ class SetupTaskMixin:
         return await super().async_ready()
 
     def create_stamp(self, stamp, contents):
+        kv_stamps = _kv_stamps_for(self)
+        if kv_stamps:
+            return kv_stamps.create_stamp(self.stamp_path, stamp, contents)
         try:
             with open(os.path.join(self.stamp_path, ".stamp-" + stamp), "wt") as f:
                 # on NFS, opening a zero-length file even for truncate does not reset the utime
@@ -455,6 +599,9 @@ class SetupTaskMixin:
                     f.write(contents)
 
     def delete_stamp(self, stamp):
+        kv_stamps = _kv_stamps_for(self)
+        if kv_stamps:
+            return kv_stamps.delete_stamp(self.stamp_path, stamp)
         try:
             os.unlink(os.path.join(self.stamp_path, ".stamp-" + stamp))
         except FileNotFoundError:
@@ -466,6 +613,12 @@ class SetupTaskMixin:
         '''
         if raise_on_error not in (True, False):
             raise SyntaxError(f'raise_on_error must be a boolean. current value: {raise_on_error}')
+        kv_stamps = _kv_stamps_for(self)
+        if kv_stamps:
+            result = kv_stamps.check_stamp(self.stamp_path, stamp)
+            if result[0] is False and raise_on_error:
+                raise RuntimeError(f"stamp '{stamp}' for '{self.stamp_path}' does not exist")
+            return result
         try:
             path = Path(self.stamp_path) / f'.stamp-{stamp}'
             res = os.stat(path)
@@ -482,10 +635,397 @@ class SetupTaskMixin:
             return logger
 
 
+_current_memo = contextvars.ContextVar('carthage.setup_tasks.memo', default=None)
+
+
+# (id(instance), stamp) -> output of a mako_task rendered to check its
+# hash during the current run_setup_tasks pass
+_pass_renders = contextvars.ContextVar('carthage.setup_tasks.renders', default=None)
+
+
+def _active_memo():
+    # The current SetupTaskMemo, unless the run it belongs to is over
+    memo = _current_memo.get()
+    if memo is not None and memo.active:
+        return memo
+    return None
+
+
+class SetupTaskMemo:
+
+    '''
+    Remembers the results of :meth:`TaskWrapperBase.should_run_task` and of task hash functions for each object and task.  When many objects depend on the same task (for example through :class:`cross_object_dependency` or :func:`install_mako_task`), it is checked once rather than once per dependent.  Concurrent checks of the same task share one computation.  Entries for an object are discarded when any of its tasks is run.  Results are assumed to depend only on the object, the task and *dependency_last_run*, so a memo is only active for the duration of a run; see :func:`setup_task_memo`.  Asyncio tasks created within the run copy the context and so may outlive it; once the memo's ``with`` block exits, it is no longer :attr:`active` and such tasks check tasks afresh.
+    '''
+
+    def __init__(self):
+        # id(obj) -> (obj, {(stamp, dependency_last_run or 'hash'): future})
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+        self._token = None
+        #: True while within the memo's ``with`` block
+        self.active = False
+
+    def __enter__(self):
+        self._token = _current_memo.set(self)
+        self.active = True
+        return self
+
+    def __exit__(self, *args):
+        _current_memo.reset(self._token)
+        self._token = None
+        self.active = False
+        self._entries.clear()
+        return False
+
+    async def _memoize(self, obj, task, subkey, compute):
+        entry = self._entries.get(id(obj))
+        if entry is None or entry[0] is not obj:
+            entry = self._entries[id(obj)] = (obj, {})
+        results = entry[1]
+        key = (task.stamp, subkey)
+        future = results.get(key)
+        if future is None:
+            self.misses += 1
+            future = results[key] = asyncio.ensure_future(compute())
+            def done(future):
+                # Errors are not remembered
+                if (future.cancelled() or future.exception() is not None) \
+                   and results.get(key) is future:
+                    del results[key]
+            future.add_done_callback(done)
+        else:
+            self.hits += 1
+        # Shielded so a canceled caller does not cancel other callers
+        return await asyncio.shield(future)
+
+    def invalidate(self, obj, task):
+        # Running a task may change the inputs to other tasks of obj
+        # as well, so everything about obj is discarded.
+        self._entries.pop(id(obj), None)
+
+
+@contextlib.contextmanager
+def setup_task_memo():
+    '''
+    A context manager that makes a :class:`SetupTaskMemo` active for code (including asyncio tasks created) within it.  If a memo is already active, it is reused.  :meth:`SetupTaskMixin.run_setup_tasks` and :meth:`carthage.modeling.ModelGroup.generate` run within a memo.
+    '''
+    memo = _active_memo()
+    if memo is not None:
+        yield memo
+        return
+    with SetupTaskMemo() as memo:
+        yield memo
+
+
+def _task_predecessors(obj, tasks):
+    # Map the stamp of each task to the stamps of the tasks that must
+    # finish before it runs.  A task without requires depends on every
+    # task before it.
+    stamps = [t.stamp for t in tasks]
+    result = {}
+    for i, t in enumerate(tasks):
+        if t.requires is None:
+            result[t.stamp] = stamps[:i]
+            continue
+        result[t.stamp] = []
+        for r in t.requires:
+            if r.stamp not in stamps:
+                raise RuntimeError(f'{t.description} requires {r.description}, which is not a setup task of {obj}')
+            result[t.stamp].append(r.stamp)
+    # Check for cycles, which would never complete
+    remaining = dict(result)
+    while remaining:
+        ready = [t for t, preds in remaining.items() if not any(p in remaining for p in preds)]
+        if not ready:
+            raise RuntimeError(f'Setup tasks of {obj} have circular requirements: {", ".join(remaining)}')
+        for t in ready: del remaining[t]
+    return result
+
+
+@dataclasses.dataclass
+class PlannedTask:
+
+    #: The object the task would run on
+    object: SetupTaskMixin
+    task: TaskWrapperBase
+    #: Why the task would run; one of :data:`run_reasons`
+    reason: str
+    #: The duration :class:`~carthage.task_history.TaskHistory` predicts, or None if the task has no history
+    predicted_duration: typing.Optional[float]
+
+    def as_dict(self):
+        return dict(
+            object=_object_name(self.object),
+            task=self.task.stamp,
+            description=self.task.description,
+            reason=self.reason,
+            predicted_duration=self.predicted_duration)
+
+
+#: The reasons :meth:`TaskWrapperBase.explain_should_run` gives for running a task
+run_reasons = ('no stamp', 'not completed', 'dependency newer', 'hash changed', 'invalidated')
+
+
+@dataclasses.dataclass
+class SetupTaskPlan:
+
+    '''
+    The result of :func:`plan_setup_tasks`.
+    '''
+
+    #: The :class:`PlannedTask` for each task that would run, grouped by object in task order
+    tasks: list[PlannedTask] = dataclasses.field(default_factory=list)
+    #: How many objects were checked
+    objects_checked: int = 0
+    #: (object, exception) for objects whose tasks could not be checked
+    errors: list = dataclasses.field(default_factory=list)
+
+    @property
+    def predicted_total(self):
+        '''The predicted time to run every planned task one after another; tasks without history are not counted.'''
+        return sum(t.predicted_duration for t in self.tasks if t.predicted_duration is not None)
+
+    @property
+    def predicted_wall_time(self):
+        '''The predicted time to run the plan if objects are set up in parallel, as :meth:`carthage.modeling.ModelGroup.generate` does: the predicted time of the slowest object.'''
+        per_object = {}
+        for t in self.tasks:
+            if t.predicted_duration is not None:
+                per_object[id(t.object)] = per_object.get(id(t.object), 0.0)+t.predicted_duration
+        return max(per_object.values(), default=0.0)
+
+    @property
+    def unpredicted(self):
+        '''How many planned tasks have no history from which to predict a duration.'''
+        return sum(1 for t in self.tasks if t.predicted_duration is None)
+
+    def as_dict(self):
+        return dict(
+            tasks=[t.as_dict() for t in self.tasks],
+            objects_checked=self.objects_checked,
+            errors=[dict(object=_object_name(o), error=repr(e)) for o, e in self.errors],
+            predicted_total=self.predicted_total,
+            predicted_wall_time=self.predicted_wall_time,
+            unpredicted=self.unpredicted)
+
+    def format(self):
+        '''
+        :returns: A human readable description of the plan.
+        '''
+        def duration(d):
+            return 'unknown' if d is None else f'{d:.1f}s'
+        lines = []
+        current = None
+        for t in self.tasks:
+            if t.object is not current:
+                current = t.object
+                lines.append(f'{_object_name(current)}:')
+            lines.append(f'    {t.task.description} ({t.reason}; predicted {duration(t.predicted_duration)})')
+        for o, e in self.errors:
+            lines.append(f'{_object_name(o)}: unable to check tasks: {e!r}')
+        objects = len(set(id(t.object) for t in self.tasks))
+        lines.append(
+            f'{len(self.tasks)} tasks on {objects} of {self.objects_checked} objects would run;'
+            f' predicted {duration(self.predicted_total)} of work, {duration(self.predicted_wall_time)} elapsed'
+            + (f' ({self.unpredicted} tasks have no history)' if self.unpredicted else ''))
+        return '\n'.join(lines)
+
+
+def _object_name(obj):
+    return str(getattr(obj, 'name', None) or obj)
+
+
+async def plan_setup_tasks(objects, *, history=None) -> SetupTaskPlan:
+    '''
+    Work out which setup tasks would run on *objects* without running any of them.  Tasks are checked with :meth:`TaskWrapperBase.explain_should_run`; a task that would run is treated as having just run when checking the tasks that depend on it.  The objects are checked concurrently within a :func:`setup_task_memo`, so tasks shared between objects are checked once.
+
+    :param objects: Objects to check; objects that are not a :class:`SetupTaskMixin` are ignored.
+
+    :param history: A :class:`~carthage.task_history.TaskHistory` used to predict how long each task will take.
+
+    '''
+    objects = [o for o in objects if isinstance(o, SetupTaskMixin)]
+    plan = SetupTaskPlan(objects_checked=len(objects))
+
+    async def plan_object(obj):
+        injector = getattr(obj, 'injector', carthage.base_injector)
+        ainjector = getattr(obj, 'ainjector', None)
+        if ainjector is None:
+            ainjector = injector(AsyncInjector)
+        config = getattr(obj, 'config_layout', None)
+        if config is None:
+            config = injector(ConfigLayout)
+        tasks = list(obj.setup_tasks)
+        if config.tasks.concurrency > 1:
+            predecessors = _task_predecessors(obj, tasks)
+        else:
+            predecessors = {t.stamp: [p.stamp] for p, t in zip(tasks, tasks[1:])}
+        # stamp -> the dependency_last_run that task would pass on
+        outputs = {}
+        planned = []
+        for t in tasks:
+            dependency_last_run = max((outputs[p] for p in predecessors.get(t.stamp, ())), default=0.0)
+            should_run, last_run, reason = await t.explain_should_run(obj, dependency_last_run, ainjector=ainjector)
+            if should_run:
+                planned.append(PlannedTask(
+                    object=obj, task=t, reason=reason,
+                    predicted_duration=history.predict(t) if history else None))
+                outputs[t.stamp] = time.time()
+            else:
+                outputs[t.stamp] = last_run
+        return planned
+
+    with setup_task_memo():
+        results = await asyncio.gather(*(plan_object(o) for o in objects), return_exceptions=True)
+    for obj, result in zip(objects, results):
+        if isinstance(result, BaseException):
+            if not isinstance(result, Exception): raise result
+            plan.errors.append((obj, result))
+        else:
+            plan.tasks.extend(result)
+    return plan
+
+
+def _kv_stamps_for(obj, injector=None, config=None):
+    # The KvStamps used by obj, or None if stamps are kept in files.
+    # obj may be a class when checking stamps without an instance.
+    # Looking up the config is much slower than checking a stamp, so
+    # the result is remembered on instances.
+    try: return obj.__dict__['_kv_stamps']
+    except (KeyError, AttributeError): pass
+    if injector is None:
+        injector = getattr(obj, 'injector', carthage.base_injector)
+    if config is None:
+        config = getattr(obj, 'config_layout', None)
+        if config is None:
+            config = injector(ConfigLayout)
+    backend = config.tasks.stamp_backend
+    if backend == 'files':
+        result = None
+    elif backend == 'kvstore':
+        result = injector.get_instance(KvStamps)
+    else:
+        raise ValueError(f'Unknown stamp backend {backend}')
+    if not isinstance(obj, type):
+        try: obj.__dict__['_kv_stamps'] = result
+        except AttributeError: pass
+    return result
+
+
 def _iso_time(t):
     return datetime.datetime.fromtimestamp(t).isoformat()
 
 
+@inject_autokwargs(store=KvStore)
+class KvStamps(Injectable):
+
+    '''
+    Keeps setup task completion stamps in the :class:`~carthage.kvstore.KvStore` rather than as a ``.stamp-`` file per task.  Used by :class:`SetupTaskMixin` when the ``tasks.stamp_backend`` config option is ``kvstore``.  Each stamp is keyed by the object's *stamp_path* and the task's stamp, and records when the stamp was created and the task's hash contents.
+
+    A *stamp_path* with stamps in the store holds a :attr:`token_file` whose contents are also recorded in the store.  If the directory is removed (for example to force a rebuild), the token no longer matches and the stored stamps for that directory are discarded, just as removing the directory would discard stamp files.  The first time a directory is seen, any existing ``.stamp-`` files in it are imported with their modification times, so switching to this backend does not rerun tasks.  The files are left in place.
+
+    :meth:`prefetch` reads every stamp for an object in one pass and reads the token once; until :meth:`release`, stamps for that object are checked without touching the filesystem.
+    '''
+
+    cache_size = 65536
+
+    #: Name of the file in each *stamp_path* tying the directory to its stamps in the store
+    token_file = '.stamp-kvstore-token'
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._stamps = self.store.domain('setup_tasks/stamps', False, cache_size=self.cache_size)
+        #: stamp_path -> number of outstanding prefetches
+        self._validated = {}
+
+    @staticmethod
+    def _key(stamp_path, stamp):
+        # The empty stamp holds the directory token
+        return f'{stamp_path}|{stamp}'
+
+    def prefetch(self, stamp_path, stamps):
+        '''
+        Validate the stamps for *stamp_path* and read them all into the cache, so that checking any of *stamps* until the matching :meth:`release` reads neither the store nor the filesystem.
+        '''
+        stamp_path = str(stamp_path)
+        self._stamps.prefetch(self._key(stamp_path, ''), [self._key(stamp_path, s) for s in stamps])
+        if stamp_path not in self._validated:
+            self._validate(stamp_path)
+        self._validated[stamp_path] = self._validated.get(stamp_path, 0)+1
+
+    def release(self, stamp_path):
+        stamp_path = str(stamp_path)
+        count = self._validated.pop(stamp_path, 1)-1
+        if count: self._validated[stamp_path] = count
+
+    def _validate(self, stamp_path, create=False):
+        # Make sure the stored stamps belong to the current
+        # stamp_path directory.  If *create*, the directory is
+        # created if needed so stamps can be recorded.
+        token_path = Path(stamp_path)/self.token_file
+        try:
+            token = token_path.read_text()
+        except FileNotFoundError:
+            token = None
+        stored = self._stamps.get(self._key(stamp_path, ''))
+        if token is not None and token == stored:
+            return
+        if token is None and not create and not os.path.isdir(stamp_path):
+            # No directory and so no stamps
+            if stored is not None:
+                self.store.run_transaction(lambda txn: self._discard(stamp_path))
+            return
+        token = secrets.token_hex(16)
+        os.makedirs(stamp_path, exist_ok=True)
+        migrated = {}
+        with os.scandir(stamp_path) as entries:
+            for entry in entries:
+                if not entry.name.startswith('.stamp-') or entry.name == self.token_file: continue
+                try:
+                    with open(entry.path, 'rt') as f:
+                        migrated[entry.name[7:]] = (os.stat(f.fileno()).st_mtime, f.read())
+                except (FileNotFoundError, IsADirectoryError): pass
+        def reset(txn):
+            self._discard(stamp_path)
+            for stamp, (mtime, contents) in migrated.items():
+                self._stamps.put(self._key(stamp_path, stamp), json.dumps([mtime, contents]), overwrite=True)
+            self._stamps.put(self._key(stamp_path, ''), token, overwrite=True)
+        self.store.run_transaction(reset)
+        token_path.write_text(token)
+        if migrated:
+            logger.debug(f'Imported {len(migrated)} stamp files from {stamp_path}')
+
+    def _discard(self, stamp_path):
+        # Called within a transaction
+        for k, v in list(self._stamps.items(self._key(stamp_path, ''))):
+            self._stamps.delete(k)
+
+    def check_stamp(self, stamp_path, stamp):
+        '''
+        :returns: a tuple of the time the stamp was created and its contents, like :meth:`SetupTaskMixin.check_stamp`.
+        '''
+        stamp_path = str(stamp_path)
+        if stamp_path not in self._validated:
+            self._validate(stamp_path)
+        value = self._stamps.get(self._key(stamp_path, stamp))
+        if value is None:
+            return (False, "")
+        mtime, contents = json.loads(value)
+        return mtime, contents
+
+    def create_stamp(self, stamp_path, stamp, contents):
+        stamp_path = str(stamp_path)
+        # Always validated: the task may have removed its own stamp_path
+        self._validate(stamp_path, create=True)
+        self._stamps.put(self._key(stamp_path, stamp), json.dumps([time.time(), contents or ""]), overwrite=True)
+
+    def delete_stamp(self, stamp_path, stamp):
+        stamp_path = str(stamp_path)
+        try: self._stamps.delete(self._key(stamp_path, stamp))
+        except KvConsistency: pass
+
+
 class cross_object_dependency(TaskWrapper):
 
     '''
@@ -534,7 +1074,9 @@ class mako_task(TaskWrapper):
 
     Typically used in a :class:`~carthage.modeling.MachineModel`.  Introduces a setup task to render a mako template.  Extra keyword arguments can be :class:`InjectionKey` in which case they are instantiated in the context of the injector of the object to which the setup task is attached.  These arguments are made available in the mako template context.  The *instance* template context argument is introduced and points to  the object on which the setup task is run.
 
-If the template has a def called *hash*, this def will be rendered with the same arguments as the main template body.  This value will be stored in the completion stamp; if the hash changes, the template will be re-rendered.  For performance reasons, try to keep the hash easy to compute.
+If the template has a def called *hash*, this def will be rendered with the same arguments as the main template body.  This value will be stored in the completion stamp; if the hash changes, the template will be re-rendered.  For performance reasons, try to keep the hash easy to compute.  Without a *hash* def, the whole template is the hash; when :meth:`~SetupTaskMixin.run_setup_tasks` renders the template to check the hash, that output is written rather than rendering the template again.
+
+Compiled templates are cached in ``mako_modules`` in the state directory so that they are not recompiled by every process.
 
     '''
 
@@ -542,6 +1084,7 @@ If the template has a def called *hash*, this def will be rendered with the same
     output: str
 
     extra_attributes = frozenset({'template', 'output',
+                                  '_rendered',
                                   })
 
     def __init__(self, template, output=None, **injections):
@@ -560,12 +1103,21 @@ If the template has a def called *hash*, this def will be rendered with the same
 
         @inject(**injections)
         def hash_func(instance, **kwargs):
-            template = self.lookup.get_template(self.template)
+            template = self.lookup_for(instance).get_template(self.template)
             if template.has_def('hash'):
                 hash_template = template.get_def("hash")
                 return hash_template.render(instance=instance, **kwargs)
             else:
-                return template.render(instance=instance, **kwargs)
+                rendered = self._rendered.get(id(instance))
+                if rendered is not None:
+                    return rendered
+                rendered = template.render(instance=instance, **kwargs)
+                renders = _pass_renders.get()
+                if renders is not None:
+                    renders[(id(instance), self.stamp)] = rendered
+                return rendered
+        # id(instance) -> output already rendered for the call in progress
+        self._rendered = {}
         self.template = template
         if output is None:
             output = template
@@ -597,14 +1149,87 @@ If the template has a def called *hash*, this def will be rendered with the same
             module._mako_lookup = mako.lookup.TemplateLookup([str(templates)], strict_undefined=True)
             self.lookup = module._mako_lookup
 
+    def lookup_for(self, instance):
+        '''
+        :returns: A lookup like :attr:`lookup` that keeps compiled templates in the state directory of *instance*.
+        '''
+        # Finding the state directory is slower than rendering a small
+        # template, so the lookups are remembered on instance.
+        try:
+            lookups = instance.__dict__.setdefault('_mako_lookups', {})
+            return lookups[id(self.lookup)]
+        except KeyError:
+            pass
+        config = getattr(instance, 'config_layout', None)
+        if config is None:
+            config = getattr(instance, 'injector', carthage.base_injector)(ConfigLayout)
+        result = lookups[id(self.lookup)] = _mako_cached_lookup(self.lookup, config.state_dir)
+        return result
+
+    def __call__(self, instance, *args, **kwargs):
+        # If this run_setup_tasks pass rendered the template to decide
+        # to run this task, that output is current.  A hash remembered
+        # by the memo from earlier in a longer run may not be.
+        rendered = None
+        renders = _pass_renders.get()
+        if renders is not None:
+            rendered = renders.pop((id(instance), self.stamp), None)
+        self._rendered[id(instance)] = rendered
+        try:
+            return super().__call__(instance, *args, **kwargs)
+        finally:
+            self._rendered.pop(id(instance), None)
+
     def render(task, instance, **kwargs):
-        template = task.lookup.get_template(task.template)
+        rendered = task._rendered.get(id(instance))
+        if rendered is None:
+            template = task.lookup_for(instance).get_template(task.template)
+            rendered = template.render(
+                instance=instance,
+                **kwargs)
         output = Path(instance.stamp_path).joinpath(task.output)
         os.makedirs(output.parent, exist_ok=True)
         with open(output, "wt") as f:
-            f.write(template.render(
-                instance=instance,
-                **kwargs))
+            f.write(rendered)
+        # Completing the task stores the hash; without a hash def that
+        # is this output.
+        if id(instance) in task._rendered:
+            task._rendered[id(instance)] = rendered
+
+
+_mako_lookups = {}
+
+
+def _mako_cached_lookup(lookup, state_dir):
+    import mako.lookup
+    key = (id(lookup), str(state_dir))
+    try:
+        return _mako_lookups[key][1]
+    except KeyError:
+        pass
+    if lookup.module_directory:
+        # A module supplied its own _mako_lookup with a cache
+        result = lookup
+    else:
+        # Templates with the same name in different directories must
+        # not share compiled modules.
+        digest = hashlib.sha256('\0'.join(lookup.directories).encode()).hexdigest()[:16]
+        template_args = dict(lookup.template_args)
+        template_args['module_directory'] = str(Path(state_dir)/'mako_modules'/digest)
+        result = mako.lookup.TemplateLookup(
+            lookup.directories,
+            filesystem_checks=lookup.filesystem_checks,
+            collection_size=lookup.collection_size,
+            modulename_callable=lookup.modulename_callable,
+            **template_args)
+    # Holding lookup keeps its id from being reused
+    _mako_lookups[key] = (lookup, result)
+    return result
+
+
+def _file_digest(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
 
 
 def find_mako_tasks(tasks):
@@ -613,6 +1238,16 @@ def find_mako_tasks(tasks):
             yield t
 
 
+def _installs_by_rsync(obj):
+    # True if install_mako_task should rsync to obj rather than copy
+    # through its filesystem_access.
+    from .machine import Machine
+    from .local import LocalMachineMixin
+    return isinstance(obj, Machine) \
+        and not isinstance(obj, LocalMachineMixin) \
+        and not obj.rsync_uses_filesystem_access
+
+
 def install_mako_task(relationship, cross_dependency=True):
     '''
 :param relationship: The name of an attribute property containing :class:`mako_tasks <mako_task>` in its :meth:`~SetupTaskMixin.setup_tasks`.
@@ -623,22 +1258,50 @@ def install_mako_task(relationship, cross_dependency=True):
 
         install_mako = install_mako_task('model')
 
+    A manifest of the digests of installed files is kept in the *stamp_path* of the object, and only files that have changed since the last installation are copied.  If the task has no stamp (for example because it was deleted to force reinstallation), every file is copied.  Remote machines (those that are not a :class:`~carthage.local.LocalMachineMixin` and do not use :meth:`~carthage.machine.Machine.filesystem_access` for rsync) receive the changed files in a single rsync rather than copies through sshfs; everything else has the files copied through :meth:`filesystem_access`.
+
     '''
     @setup_task("Install mako templates")
     async def install(self):
-        async with self.filesystem_access() as fspath:
-            related = getattr(self, relationship)
-            await related.async_become_ready()
-            base = Path(related.stamp_path)
-            path = Path(fspath)
-            for mt in find_mako_tasks(related.setup_tasks):
-                if os.path.isabs(mt.output):
-                    logger.warn(f'{mt} has absolute path; skipping install')
-                    continue
-                src = base / mt.output
-                dest = path / mt.output
-                os.makedirs(dest.parent, exist_ok=True)
-                shutil.copy2(src, dest)
+        related = getattr(self, relationship)
+        await related.async_become_ready()
+        base = Path(related.stamp_path)
+        digests = {}
+        for mt in find_mako_tasks(related.setup_tasks):
+            if os.path.isabs(mt.output):
+                logger.warn(f'{mt} has absolute path; skipping install')
+                continue
+            digests[mt.output] = _file_digest(base/mt.output)
+        manifest_path = Path(self.stamp_path)/f'.install-{relationship}-manifest.json'
+        manifest = {}
+        if self.check_stamp(install.stamp)[0]:
+            try:
+                manifest = json.loads(manifest_path.read_text())
+            except (FileNotFoundError, ValueError):
+                pass
+        changed = [output for output, digest in digests.items() if manifest.get(output) != digest]
+        if not changed:
+            return
+        logger.debug(f'Installing {len(changed)} of {len(digests)} templates on {self}')
+        os.makedirs(manifest_path.parent, exist_ok=True)
+        if not _installs_by_rsync(self):
+            async with self.filesystem_access() as fspath:
+                path = Path(fspath)
+                for output in changed:
+                    dest = path / output
+                    os.makedirs(dest.parent, exist_ok=True)
+                    shutil.copy2(base / output, dest)
+        else:
+            with tempfile.NamedTemporaryFile('wt', dir=self.stamp_path, prefix='.install-') as files_from:
+                files_from.write(''.join(output+'\n' for output in changed))
+                files_from.flush()
+                async with self.machine_running(ssh_online=True):
+                    # Like shutil.copy2, preserve modes and times but not ownership
+                    await self.rsync('-rlpt', '--files-from', files_from.name,
+                                     str(base)+'/', self.rsync_path('/'))
+        tmp = manifest_path.with_name(manifest_path.name+'.tmp')
+        tmp.write_text(json.dumps(digests))
+        os.replace(tmp, manifest_path)
     if cross_dependency:
         @install.invalidator()
         @inject(ainjector=AsyncInjector)
@@ -0,0 +1,298 @@
+# Copyright (C) 2023, Hadron Industries, Inc.
+# Carthage is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License version 3
+# as published by the Free Software Foundation. It is distributed
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the file
+# LICENSE for details.
+
+'''
+A record of how long setup tasks take.  :meth:`~carthage.setup_tasks.SetupTaskMixin.run_setup_tasks` appends a :class:`TaskRecord` for each task it runs to ``task_history.jsonl`` in the state directory.  The history is used to predict how long a :func:`~carthage.setup_tasks.plan_setup_tasks` plan will take, and is summarized by ``carthage-runner stats``.
+'''
+
+from __future__ import annotations
+import dataclasses
+import json
+import logging
+import os
+import statistics
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+__all__ = []
+
+logger = logging.getLogger('carthage.task_history')
+
+#: Identifies the records made by this process, so that one run can be compared with earlier runs
+run_id = f'{int(time.time())}-{os.getpid()}'
+
+
+@dataclasses.dataclass
+class TaskRecord:
+
+    #: The stamp of the task; tasks with the same stamp on different objects are treated as the same type of task
+    task: str
+    #: The name of the object on which the task ran
+    object: str
+    start: float
+    end: float
+    #: ``success``, ``failure`` or ``skipped``
+    outcome: str
+    #: The :data:`run_id` of the process that ran the task
+    run: str = ''
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+
+__all__ += ['TaskRecord']
+
+
+class TaskHistory:
+
+    '''
+    The :class:`TaskRecord` history stored in *path*.  Use :func:`task_history` to find the history for a state directory.
+
+    :param max_records: Once the file holds twice this many records, it is rewritten keeping only the most recent *max_records*.  If 0, the history grows without bound.
+    '''
+
+    #: How many recent successful runs of a task type :meth:`predict` considers
+    prediction_window = 20
+
+    def __init__(self, path, max_records=10000):
+        self.path = Path(path)
+        self.max_records = max_records
+        self._records = None
+        # stamp -> durations of successful runs
+        self._durations = None
+        # (inode, size) of the file as of the records we hold
+        self._file_state = None
+        # Number of records in the file, and the (inode, size) of the
+        # file when they were counted
+        self._count = 0
+        self._counted = None
+        self._lock = threading.Lock()
+
+    def _stat(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return st.st_ino, st.st_size
+
+    def refresh(self):
+        '''Discard records read from the file if another process (or a removal) has changed it.'''
+        if self._records is not None and self._stat() != self._file_state:
+            self._records = self._durations = None
+
+    @property
+    def records(self) -> list[TaskRecord]:
+        '''All records, oldest first.'''
+        if self._records is None:
+            self._records = []
+            self._durations = {}
+            self._file_state = self._stat()
+            for r in self._read():
+                self._add(r)
+        return self._records
+
+    def _add(self, record):
+        self._records.append(record)
+        if record.outcome == 'success':
+            self._durations.setdefault(record.task, []).append(record.duration)
+
+    def _read(self):
+        try:
+            f = self.path.open('rt')
+        except FileNotFoundError:
+            return
+        with f:
+            for line in f:
+                try:
+                    yield TaskRecord(**json.loads(line))
+                except (ValueError, TypeError):
+                    # A partially written line from an interrupted run
+                    continue
+
+    def record(self, obj, task, start, end, outcome):
+        '''Record that *task* ran on *obj* from *start* to *end*.'''
+        record = TaskRecord(
+            task=task.stamp,
+            object=str(getattr(obj, 'name', None) or obj),
+            start=start, end=end, outcome=outcome, run=run_id)
+        line = json.dumps(dataclasses.asdict(record))+'\n'
+        with self._lock:
+            try:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                file_state = self._stat()
+                with self.path.open('at') as f:
+                    f.write(line)
+                new_state = self._stat()
+                if self._records is not None:
+                    if file_state == self._file_state:
+                        self._add(record)
+                        self._file_state = new_state
+                    else:
+                        # Reread only when records are next needed
+                        self._records = self._durations = None
+                if file_state is not None and file_state == self._counted:
+                    self._count += 1
+                    self._counted = new_state
+                else:
+                    self._update_count(new_state)
+                if self.max_records and self._count > 2*self.max_records:
+                    self._compact()
+            except OSError:
+                logger.exception(f'Unable to record task history in {self.path}')
+        return record
+
+    def _update_count(self, file_state):
+        # Bring _count up to date with the file as of file_state,
+        # reading only what has been appended since it was last
+        # counted unless the file has been replaced.
+        if file_state is None:
+            self._count, self._counted = 0, None
+            return
+        offset, count = 0, 0
+        if self._counted is not None and self._counted[0] == file_state[0] \
+           and self._counted[1] <= file_state[1]:
+            offset, count = self._counted[1], self._count
+        with self.path.open('rb') as f:
+            f.seek(offset)
+            count += f.read(file_state[1]-offset).count(b'\n')
+        self._count, self._counted = count, file_state
+
+    def _compact(self):
+        # Replaced rather than truncated so that readers never see a
+        # partial file.  A record appended by another process while
+        # the file is rewritten may be lost, which is acceptable for
+        # a history.
+        records = self.records[-self.max_records:]
+        fd, tmp = tempfile.mkstemp(dir=self.path.parent, prefix='.task_history')
+        try:
+            with open(fd, 'wt') as f:
+                for r in records:
+                    f.write(json.dumps(dataclasses.asdict(r))+'\n')
+            os.replace(tmp, self.path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        self._records = []
+        self._durations = {}
+        for r in records:
+            self._add(r)
+        self._file_state = self._stat()
+        self._count, self._counted = len(records), self._file_state
+
+    def durations(self, task):
+        '''
+        :returns: Durations of successful runs of tasks with the same stamp as *task* (which may be a stamp), oldest first.
+        '''
+        stamp = task if isinstance(task, str) else task.stamp
+        self.records
+        return list(self._durations.get(stamp, ()))
+
+    def predict(self, task):
+        '''
+        :returns: The expected duration of *task* in seconds: the median of the most recent :attr:`prediction_window` successful runs, or None if it has never run.
+        '''
+        durations = self.durations(task)[-self.prediction_window:]
+        if not durations:
+            return None
+        return statistics.median(durations)
+
+    def runs(self) -> list[str]:
+        '''
+        :returns: The run ids in the history, oldest first.
+        '''
+        return list(dict.fromkeys(r.run for r in self.records))
+
+    def task_stats(self, records=None) -> dict[str, dict]:
+        '''
+        Summarize *records* (by default the whole history) by task stamp.
+
+        :returns: A dictionary mapping each stamp to a dictionary with the number of *runs*, *failures*, and for successful runs the *p50*, *p95* and *total* duration.
+        '''
+        if records is None: records = self.records
+        by_task = {}
+        for r in records:
+            by_task.setdefault(r.task, []).append(r)
+        result = {}
+        for stamp, task_records in by_task.items():
+            durations = sorted(r.duration for r in task_records if r.outcome == 'success')
+            result[stamp] = dict(
+                runs=len(task_records),
+                failures=sum(1 for r in task_records if r.outcome == 'failure'),
+                p50=_percentile(durations, 50),
+                p95=_percentile(durations, 95),
+                total=sum(durations))
+        return result
+
+    def slowest_objects(self, count=10, records=None) -> list[tuple[str, float]]:
+        '''
+        :returns: Up to *count* (object, total duration) tuples for the objects whose tasks took longest in *records* (by default the whole history), slowest first.
+        '''
+        if records is None: records = self.records
+        totals = {}
+        for r in records:
+            totals[r.object] = totals.get(r.object, 0.0)+r.duration
+        return sorted(totals.items(), key=lambda t: t[1], reverse=True)[:count]
+
+    def regressions(self, threshold=1.25, min_duration=0.1) -> list[tuple[str, float, float]]:
+        '''
+        Compare the most recent run with the runs before it.
+
+        :param threshold: A task has regressed if its median duration in the most recent run is more than *threshold* times its median in the earlier runs.
+
+        :param min_duration: Tasks faster than this in the most recent run are ignored; their timing is mostly noise.
+
+        :returns: (stamp, earlier median, latest median) tuples, largest slowdown first.
+        '''
+        runs = self.runs()
+        if len(runs) < 2:
+            return []
+        latest = self.task_stats([r for r in self.records if r.run == runs[-1]])
+        earlier = self.task_stats([r for r in self.records if r.run != runs[-1]])
+        result = []
+        for stamp, stats in latest.items():
+            current = stats['p50']
+            previous = earlier.get(stamp, {}).get('p50')
+            if current is None or previous is None or current < min_duration:
+                continue
+            if current > previous*threshold:
+                result.append((stamp, previous, current))
+        result.sort(key=lambda r: r[2]/max(r[1], 1e-9), reverse=True)
+        return result
+
+
+__all__ += ['TaskHistory']
+
+
+def _percentile(durations, percent):
+    # Nearest rank percentile of sorted durations
+    if not durations:
+        return None
+    rank = max(1, -(-len(durations)*percent//100))
+    return durations[int(rank)-1]
+
+_histories: dict[Path, TaskHistory] = {}
+
+
+def task_history(config_layout) -> TaskHistory:
+    '''
+    :returns: The :class:`TaskHistory` kept in the state directory of *config_layout*.
+    '''
+    path = Path(config_layout.state_dir)/'task_history.jsonl'
+    try:
+        history = _histories[path]
+    except KeyError:
+        history = _histories.setdefault(path, TaskHistory(path))
+    history.max_records = config_layout.tasks.history_size
+    history.refresh()
+    return history
+
+
+__all__ += ['task_history']
@@ -0,0 +1 @@
+The value is ${value()}.
@@ -360,6 +360,24 @@ def test_injection_key_copy():
     assert i2 is not i1
 
 
+def test_constrained_injection_key_interning():
+    k1 = InjectionKey(int, name='foo')
+    assert InjectionKey(int, name='foo') is k1
+    assert hash(InjectionKey(int, name='foo')) == hash(k1)
+    k_optional = InjectionKey(k1, _optional=True)
+    assert k_optional is not k1
+    assert k_optional == k1
+    assert InjectionKey(int, name='foo', _optional=True) is k_optional
+    # Equal values of different types are not conflated
+    assert InjectionKey(int, name='foo', _optional=1) is not k_optional
+    assert InjectionKey(int, name='foo', _optional=1).optional == 1
+    # Keys with unhashable constraints can still be constructed and compared
+    k_list = InjectionKey(int, name=['foo'])
+    assert k_list == InjectionKey(int, name=['foo'])
+    with pytest.raises(TypeError):
+        hash(k_list)
+
+
 def test_none_kwargs():
     class foo(dependency_injection.Injectable):
         pass
@@ -645,3 +663,154 @@ async def test_resolve_deferred(ainjector):
         dict(a=10, b=20),
         dict(c='foo', d=40),
         'bar']
+
+
+def test_filter_only_examines_target(injector):
+    "filter should only consider keys for the requested target regardless of how many unrelated keys are registered"
+    class Wanted(Injectable):
+        pass
+
+    class Unwanted(Injectable):
+        pass
+    sub_injector = injector(Injector)
+    for i in range(2000):
+        injector.add_provider(InjectionKey(Unwanted, name=f'u{i}'), Unwanted)
+    injector.add_provider(InjectionKey(Wanted, name='w1'), Wanted)
+    sub_injector.add_provider(InjectionKey(Wanted, name='w2'), Wanted)
+    sub_injector.add_provider(InjectionKey(Wanted, other='o'), Wanted)
+    # The two added keys plus the supplementary InjectionKey(Wanted)
+    assert len(sub_injector._target_keys[Wanted]) == 3
+    assert sub_injector.filter(Wanted, ['name']) == [
+        InjectionKey(Wanted, name='w1'), InjectionKey(Wanted, name='w2')]
+    assert sub_injector.filter(Wanted, ['name'], stop_at=sub_injector) == [
+        InjectionKey(Wanted, name='w2')]
+    assert len(injector.filter(Unwanted, ['name'])) == 2000
+
+
+def test_resolution_cache_invalidated(injector):
+    k = InjectionKey('cached')
+    missing = InjectionKey('missing')
+    injector.add_provider(k, 1)
+    sub_injector = injector(Injector)(Injector)
+    assert sub_injector.get_instance(k) == 1
+    assert sub_injector.get_instance(k) == 1
+    assert sub_injector.get_instance(InjectionKey(missing, _optional=True)) is None
+    # Adding a closer provider must take effect despite the cached lookup
+    sub_injector.parent_injector.add_provider(k, 2)
+    injector.add_provider(missing, 3)
+    assert sub_injector.get_instance(k) == 2
+    assert sub_injector.get_instance(missing) == 3
+    injector.replace_provider(missing, 4)
+    assert sub_injector.get_instance(missing) == 4
+
+
+def test_resolution_cache_scope(injector):
+    k = InjectionKey('scoped')
+    injector.add_provider(k, 1)
+    left = injector(Injector)
+    right = injector(Injector)
+    assert left.get_instance(k) == right.get_instance(k) == 1
+    # Changes only invalidate resolutions in the affected subtree
+    generation = injector._generation
+    left.add_provider(k, 2)
+    assert injector._generation == generation
+    assert left.get_instance(k) == 2
+    assert right.get_instance(k) == 1
+    # Instantiating an AsyncInjectable leaves resolutions alone
+    left(AsyncInjector)
+    assert injector._generation == generation
+    # Misses are bounded too
+    for i in range(right.resolution_cache_size*2):
+        right.get_instance(InjectionKey(f'missing-{i}', _optional=True))
+    assert len(right._resolution_cache) <= right.resolution_cache_size
+    # Closing an injector discards what its sub-injectors cached from it
+    sub = left(Injector)
+    assert sub.get_instance(k) == 2
+    left.close()
+    assert sub.get_instance(InjectionKey(k, _optional=True)) is None
+
+
+def test_async_injector_delegates(injector, loop):
+    ainjector = injector(AsyncInjector)
+    assert set(ainjector.__dict__) == {'injector', 'loop'}
+    assert injector.get_instance(AsyncInjector) is ainjector
+    k = InjectionKey('delegated')
+    ainjector.add_provider(k, 42)
+    assert ainjector.get_instance(k) == 42
+    assert k in injector
+    assert ainjector.filter(str) == injector.filter(str)
+
+
+@async_test
+async def test_add_providers(injector, loop):
+    class Provided(Injectable):
+        pass
+    k1 = InjectionKey(Provided, name='one')
+    k2 = InjectionKey(Provided, name='two')
+    dp = DependencyProvider(Provided)
+    events = []
+
+    def callback(**kwargs):
+        events.append(kwargs)
+    injector.add_event_listener(InjectionKey(Provided), 'add_providers', callback)
+    injector.add_provider(InjectionKey('existing'), 1)
+    with pytest.raises(ExistingProvider) as excinfo:
+        injector.add_providers({k1: dp, InjectionKey('existing'): 2})
+    assert excinfo.value.injection_key == InjectionKey('existing')
+    assert excinfo.value.provider == 2
+    assert k1 not in injector
+    assert injector.add_providers({k1: dp, k2: dp}) == [k1, k2]
+    assert injector.get_instance(k1) is injector.get_instance(k2)
+    assert injector.get_instance(Provided) is injector.get_instance(k1)
+    await asyncio.sleep(0)
+    assert len(events) == 1
+    assert set(events[0]['providers']) == {k1, k2}
+
+
+def test_supplementary_keys_cached():
+    from carthage.dependency_injection.base import _supplementary_keys_cache
+
+    class Base(Injectable):
+        pass
+
+    class Derived(Base):
+        pass
+    k = InjectionKey(Derived, name='foo')
+    expected = {InjectionKey(Base), InjectionKey(Base, name='foo'), InjectionKey(Derived)}
+    assert set(Derived.supplementary_injection_keys(k)) == expected
+    assert (Derived, k) in _supplementary_keys_cache
+    assert set(Derived.supplementary_injection_keys(k)) == expected
+
+    class MoreDerived(Derived):
+        pass
+    assert (Derived, k) not in _supplementary_keys_cache
+    assert InjectionKey(Derived, name='foo') in set(
+        MoreDerived.supplementary_injection_keys(InjectionKey(MoreDerived, name='foo')))
+
+
+@async_test
+async def test_instantiation_profiler(a_injector, tmp_path):
+    import json
+    from carthage.dependency_injection.profiler import InstantiationProfiler
+
+    class Slow(AsyncInjectable):
+
+        async def async_ready(self):
+            await asyncio.sleep(0.05)
+            return await super().async_ready()
+
+    @inject_autokwargs(slow=Slow)
+    class Outer(AsyncInjectable):
+        pass
+    a_injector.add_provider(Slow)
+    a_injector.add_provider(Outer)
+    with InstantiationProfiler() as profiler:
+        await a_injector.get_instance_async(Outer)
+    outer_record = profiler.critical_path()[0]
+    assert 'Outer' in outer_record.description
+    assert outer_record.blocked >= 0.04
+    assert any('Slow' in r.description and r.parent is outer_record for r in profiler.records)
+    assert 'Critical path' in profiler.format_report()
+    profiler.write_chrome_trace(tmp_path/'trace.json')
+    trace = json.loads((tmp_path/'trace.json').read_text())
+    assert len(trace['traceEvents']) == len(profiler.records)
@@ -6,6 +6,7 @@
 # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the file
 # LICENSE for details.
 
+import asyncio
 import pytest
 from carthage.event import EventListener
 from carthage.pytest import *
@@ -70,3 +71,101 @@ def test_multiple_scope_breaks(loop):
     key = InjectionKey("event")
     injector3.add_event_listener(key, "foo", callback)
     injector2.add_event_listener(key, "foo", callback)
+
+
+@async_test
+async def test_scope_breaks_reparent(loop):
+    calls = []
+
+    def callback(**kwargs):
+        calls.append(kwargs['key'])
+    injector = base_injector(Injector)
+    injector2 = injector(Injector)
+    injector3 = injector2(Injector)
+    injector4 = injector3(Injector)
+    assert injector4._event_scope is injector._event_scope
+    injector3.add_event_listener("three", "ev", callback)
+    assert injector4._event_scope is injector3._event_scope
+    assert injector2._event_scope is injector._event_scope
+    # Breaking above an existing scope must not disturb it
+    injector2.add_event_listener("two", "ev", callback)
+    assert injector4._event_scope is injector3._event_scope
+    assert injector3._event_scope.parent is injector2._event_scope
+    await injector4.emit_event("three", "ev", injector4, adl_keys={"two"})
+    assert sorted(calls) == ["three", "two"]
+    calls.clear()
+    # Children created after a break share the new scope
+    injector5 = injector2(Injector)
+    assert injector5._event_scope is injector2._event_scope
+    await injector5.emit_event("three", "ev", injector5, adl_keys={"two"})
+    assert calls == ["two"]
+
+
+@async_test
+async def test_emit_without_listeners(loop):
+    injector = base_injector(Injector)
+    injector2 = injector(Injector)
+    key = InjectionKey("unheard")
+    scope = injector2._event_scope
+    assert not scope.has_listeners(key, "foo")
+    assert await injector2.emit_event(key, "foo", injector2) == []
+    # Still a future, usable with asyncio.wait and gather
+    result = injector2.emit_event(key, "foo", injector2)
+    assert asyncio.isfuture(result) and result.done()
+    await asyncio.wait([result])
+    assert await asyncio.gather(result) == [[]]
+    calls = []
+
+    def callback(**kwargs):
+        calls.append(kwargs['key'])
+    with injector.event_listener_context(key, ["foo", "bar"], callback):
+        assert injector2._event_scope.has_listeners(key, "foo")
+        assert injector2._event_scope.has_listeners("other", "bar", adl_keys={key})
+        assert not injector2._event_scope.has_listeners(key, "baz")
+        await injector2.emit_event(key, "foo", injector2)
+        assert calls == [key]
+    assert not injector2._event_scope.has_listeners(key, "foo")
+    assert not injector2._event_scope.has_listeners(key, "bar")
+
+
+@async_test
+async def test_sync_callbacks_inline(loop):
+    listener = EventListener()
+    listener.loop = loop
+    seen = []
+
+    def sync_cb(**kwargs):
+        seen.append(('sync', kwargs['key'], kwargs['target_key'], kwargs['extra']))
+        return 'sync'
+
+    async def async_cb(**kwargs):
+        seen.append(('async', kwargs['key'], kwargs['target_key'], kwargs['extra']))
+        return 'async'
+    listener.add_event_listener("foo", "ev", sync_cb)
+    listener.add_event_listener("bar", "ev", async_cb)
+    tasks_before = len(asyncio.all_tasks())
+    result = listener.emit_event("foo", "ev", listener, adl_keys={"bar"}, extra=1)
+    # Only the coroutine callback needs a task
+    assert len(asyncio.all_tasks()) == tasks_before + 1
+    assert sorted(await result) == ['async', 'sync']
+    assert sorted(seen) == [('async', 'bar', 'foo', 1), ('sync', 'foo', 'foo', 1)]
+    assert await listener.emit_event("foo", "ev", listener, extra=2) == ['sync']
+
+
+@async_test
+async def test_ordered_listener(loop):
+    listener = EventListener()
+    listener.loop = loop
+    order = []
+
+    async def callback(n, **kwargs):
+        # Later events finish sooner unless the listener is ordered
+        await asyncio.sleep(0.01 * (3 - n))
+        order.append(n)
+    listener.add_event_listener("ordered", "ev", callback, ordered=True)
+    await asyncio.gather(*(listener.emit_event("ordered", "ev", listener, n=n) for n in range(3)))
+    assert order == [0, 1, 2]
+    order.clear()
+    listener.add_event_listener("unordered", "ev", callback)
+    await asyncio.gather(*(listener.emit_event("unordered", "ev", listener, n=n) for n in range(3)))
+    assert order == [2, 1, 0]
@@ -5,7 +5,9 @@
 # WITHOUT ANY WARRANTY; without even the implied warranty of
 # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the file
 # LICENSE for details.
+import argparse
 import dataclasses
+import json
 import os
 import shutil
 import pytest
@@ -14,6 +16,7 @@ import carthage
 from carthage.pytest import *
 from carthage import *
 from carthage.kvstore import *
+from carthage.kvstore import kv_key
 from carthage.modeling import *
 
 class TestAssignments(HashedRangeAssignments):
@@ -161,6 +164,8 @@ async def test_dump_load(ainjector):
     o3 = AssignedObj(1,6)
     o4 = AssignedObj(3,5)
     objs = [o1, o2, o3, o4]
+    # Fixed preferences; greedy assignment of these ranges can exhaust depending on how the keys hash
+    for o, hash in zip(objs, (1, 2, 6, 3)): o.hash = hash
     assignments = await ainjector(TestAssignments, objs)
     assignments.do_assignments()
     kvstore = ainjector.get_instance(KvStore)
@@ -177,6 +182,299 @@ async def test_dump_load(ainjector):
         assert o.assignment == correct_assignments[o.key]
         
     
+@async_test
+async def test_transaction(ainjector):
+    kvstore = ainjector.get_instance(KvStore)
+    domain = kvstore.domain('transaction_test', False)
+    with kvstore.transaction() as txn:
+        domain.put('a', '1')
+        with kvstore.transaction() as inner:
+            assert inner is txn
+            domain.put('b', '2')
+        assert domain.get('a') == '1'
+    assert domain['b'] == '2'
+    with pytest.raises(KeyError):
+        with kvstore.transaction():
+            domain.put('c', '3')
+            del domain['a']
+            raise KeyError('abort')
+    assert domain.get('c') is None
+    assert domain['a'] == '1'
+    with kvstore.transaction(write=False):
+        assert domain['b'] == '2'
+        with pytest.raises(RuntimeError):
+            domain.put('d', '4')
+
+
+@async_test
+async def test_read_cache(ainjector):
+    kvstore = ainjector.get_instance(KvStore)
+    domain = kvstore.domain('cached', False, cache_size=2)
+    other = kvstore.domain('cached', False)
+    assert other.cache is domain.cache
+    cache = domain.cache
+    domain.put('a', '1')
+    assert domain['a'] == '1'
+    assert domain['a'] == '1'
+    assert domain.get('missing') is None
+    assert domain.get('missing') is None
+    # put populated 'a'
+    assert (cache.hits, cache.misses) == (3, 1)
+    # Our own writes through any KvDomain update the cache
+    other.put('a', '2', overwrite=True)
+    assert domain['a'] == '2'
+    other.put('missing', 'present')
+    assert domain['missing'] == 'present'
+    # A write the cache did not see (as from another process)
+    with kvstore.environment.begin(write=True) as txn:
+        txn.put(kv_key('cached', 'a'), b'3')
+    assert domain['a'] == '3'
+    # Aborted writes are not remembered
+    with pytest.raises(KeyError):
+        with kvstore.transaction():
+            domain.put('b', '1')
+            assert domain['b'] == '1'
+            raise KeyError
+    assert domain.get('b') is None
+    # An abort only forgets the domains the transaction wrote to
+    untouched = kvstore.domain('untouched', False, cache_size=2)
+    untouched.put('x', '1')
+    with pytest.raises(KvConsistency):
+        with kvstore.transaction():
+            domain.put('b', '1')
+            untouched.put('x', '2')
+    assert untouched.cache.entries['x'] == '1'
+    with pytest.raises(KeyError):
+        with kvstore.transaction():
+            domain.put('b', '1')
+            raise KeyError
+    assert 'x' in untouched.cache.entries
+    # Within a read transaction the cache is checked once
+    with kvstore.transaction(write=False):
+        assert domain['a'] == '3'
+    # Bounded
+    for k in 'cdef': domain.get(k)
+    assert len(cache.entries) == 2
+    assert kvstore.cache_stats()['cached'] is cache
+
+
+@async_test
+async def test_hash_strategy(ainjector):
+    assert sum_key_hash('web2|eth0') - sum_key_hash('web1|eth0') == 1
+    assert sum_key_hash('ab') == sum_key_hash('ba')
+    assert blake2b_key_hash('ab') != blake2b_key_hash('ba')
+    # Must never change, or assignments without hints would move
+    assert blake2b_key_hash('web1|eth0') == 0x8bd86ac6540bc230
+    fresh = await ainjector(TestAssignments, [])
+    assert fresh._find_key_hash() is blake2b_key_hash
+    # A domain that already has hints keeps the historical hash
+    kvstore = ainjector.get_instance(KvStore)
+    kvstore.domain('existing/hints', True).put('web1|eth0', '5')
+    existing = await ainjector(TestAssignments, [])
+    existing._hints = kvstore.domain('existing/hints', True)
+    existing._settings = kvstore.domain('existing/settings', True)
+    assert existing._find_key_hash() is sum_key_hash
+    assert existing._settings.get('hash_strategy') == 'sum'
+    # And the recorded strategy is used even once hints are gone
+    existing._hints.delete('web1|eth0')
+    assert existing._find_key_hash() is sum_key_hash
+
+
+@async_test
+async def test_allocation_bitmap(ainjector):
+    import random
+    class SmallBitmap(AllocationBitmap):
+        block_bits = 4
+    kvstore = ainjector.get_instance(KvStore)
+    bitmap = SmallBitmap(kvstore.domain('bitmap_test', False))
+    allocated = set()
+    rng = random.Random(4)
+    for i in range(400):
+        slot = rng.randrange(100)
+        bitmap.set(slot, slot not in allocated)
+        allocated ^= {slot}
+        low = rng.randrange(100)
+        high = rng.randrange(low, 100)
+        hash = rng.randrange(low, high+1)
+        free = [n for n in range(low, high+1) if n not in allocated]
+        expected = min(free, key=lambda n: (abs(n-hash), -n)) if free else None
+        assert bitmap.nearest_free(hash, low, high) == expected
+
+
+@async_test
+async def test_allocation_index_matches_probing(ainjector):
+    # Clustered hashes so that most keys need to search for a free slot
+    def objs():
+        result = [AssignedObj(0, 99, key=f'cluster{i}') for i in range(60)]
+        for i, o in enumerate(result): o.hash = 40 + (i % 7)
+        return result
+    indexed = await ainjector(TestAssignments, objs())
+    probed = await ainjector(TestAssignments, objs())
+    probed._assignments = probed.store.domain('probed/assignments', False)
+    probed._hints = probed.store.domain('probed/hints', False)
+    probed.prefer_reallocate = True # Disables the index
+    indexed.do_assignments()
+    probed.do_assignments()
+    indexed.check_consistency()
+    assert [o.assignment for o in indexed.objs] == [o.assignment for o in probed.objs]
+
+
+@async_test
+async def test_fill_slash_16(ainjector):
+    "Fill a /16 sized range to 99% occupancy"
+    objs = [AssignedObj(0, 65535) for i in range(int(65536*0.99))]
+    assignments = await ainjector(TestAssignments, objs)
+    with assignments.store.transaction():
+        assignments.do_assignments()
+    assignments.check_consistency()
+    # Losing the bitmap rebuilds it from the assignments
+    assignments2 = await ainjector(TestAssignments, objs)
+    assignments2._allocated.domain.delete('format')
+    extra = AssignedObj(0, 65535)
+    assignments2.objs = objs+[extra]
+    with assignments2.store.transaction():
+        assignments2.do_assignments()
+    assignments2.check_consistency()
+
+
+@async_test
+async def test_moved_assignment_released(ainjector):
+    o = AssignedObj(0, 9)
+    assignments = await ainjector(TestAssignments, [o])
+    assignments.do_assignments()
+    old = o.assignment
+    assert old in assignments._allocation_index()
+    # The range moves, so the key moves; its old slot is freed
+    o.low, o.high = 10, 19
+    assignments.do_assignments()
+    assert 10 <= o.assignment <= 19
+    assert assignments._assignments.get(str(old)) is None
+    assert old not in assignments._allocation_index()
+    other = AssignedObj(0, 9)
+    other.hash = old
+    assignments.objs.append(other)
+    assignments.do_assignments()
+    assert other.assignment == old
+
+
+@async_test
+async def test_export_load(ainjector):
+    kvstore = ainjector.get_instance(KvStore)
+    hints = kvstore.domain('export/hints', True)
+    private = kvstore.domain('export/assignments', False)
+    for i in range(10): hints.put(f'k{i}', str(i))
+    private.put('x', 'y')
+    path = state_dir/'export.jsonl'
+    assert kvstore.export(path, lambda d, k, v: k != 'k9') == 9
+    # Nothing changed
+    assert kvstore.export(path, lambda d, k, v: True, differential=True) == 1
+    assert kvstore.export(path, lambda d, k, v: True, differential=True) == 0
+    hints.put('k0', 'changed', overwrite=True)
+    hints.delete('k1')
+    hints.put('k10', '10')
+    assert kvstore.export(path, lambda d, k, v: True, differential=True) == 3
+    # Superseded lines never outnumber the live entries
+    for i in range(30):
+        hints.put('k0', f'changed{i}', overwrite=True)
+        kvstore.export(path, lambda d, k, v: True, differential=True)
+        assert len(path.read_text().splitlines())-1 <= 2*10
+    hints.put('k0', 'changed', overwrite=True)
+    kvstore.export(path, lambda d, k, v: True, differential=True)
+    full = state_dir/'full.jsonl'
+    kvstore.export(full, lambda d, k, v: True)
+    with kvstore.environment.begin(write=True) as txn, txn.cursor() as csr:
+        csr.first()
+        while csr.delete(): pass
+    hints.put('k2', 'kept')
+    kvstore.load(path)
+    assert hints['k0'] == 'changed'
+    assert hints.get('k1') is None
+    assert hints['k2'] == 'kept'
+    assert hints['k10'] == '10'
+    assert private.get('x') is None
+    loaded = dict(hints.items())
+    with kvstore.environment.begin(write=True) as txn, txn.cursor() as csr:
+        csr.first()
+        while csr.delete(): pass
+    hints.put('k2', 'kept')
+    kvstore.load(full)
+    assert dict(hints.items()) == loaded
+
+
+@async_test
+async def test_map_growth(ainjector):
+    kvstore = await ainjector(KvStore, store_dir='small_store', max_size=2**16)
+    try:
+        domain = kvstore.domain('growth', True)
+        def fill(txn):
+            for i in range(200): domain.put(str(i), 'x'*1000, overwrite=True)
+        kvstore.run_transaction(fill)
+        domain.put('single', 'y'*100000)
+        assert kvstore.environment.info()['map_size'] > 2**16
+        assert domain['199'] == 'x'*1000
+        stats = kvstore.stats()
+        assert stats['domains']['growth'] == 201
+        assert stats['domains']['dump'] == 1
+        assert 0 < stats['map_used'] <= 1
+    finally:
+        kvstore.close()
+
+
+@async_test
+async def test_sweep_assignments(ainjector):
+    objs = [AssignedObj(0, 2) for i in range(3)]
+    assignments = await ainjector(TestAssignments, objs)
+    assignments.do_assignments()
+    dead = objs.pop()
+    live_keys = {o.key for o in objs}
+    store = assignments.store
+    def live(domain, key):
+        assert domain == 'test_domain'
+        return key in live_keys
+    expected = {'test_domain': [(str(dead.assignment), dead.key)]}
+    assert store.sweep_assignments(live, dry_run=True) == expected
+    assert assignments._hints.get(dead.key) == str(dead.assignment)
+    assert store.sweep_assignments(live) == expected
+    assert assignments._hints.get(dead.key) is None
+    assert assignments._assignments.get(str(dead.assignment)) is None
+    assert store.sweep_assignments(live) == {}
+    # The same assigner notices its bitmap was invalidated by the sweep
+    assert dead.assignment not in assignments._allocation_index()
+    # Without key validation the released slot is only usable because of the sweep
+    new = AssignedObj(0, 2)
+    assignments2 = await ainjector(TestAssignments, objs+[new])
+    assignments2.do_assignments()
+    assignments2.check_consistency()
+    assert new.assignment == dead.assignment
+
+
+@async_test
+async def test_assign_retries(ainjector):
+    o = AssignedObj(0, 10)
+    assignments = await ainjector(TestAssignments, [o])
+    assignments.retry_backoff = 0.0001
+    real_assign_once = assignments._assign_once
+    failures = 2
+    def assign_once(key, obj):
+        nonlocal failures
+        if failures:
+            failures -= 1
+            raise KvConsistency('lost race')
+        return real_assign_once(key, obj)
+    assignments._assign_once = assign_once
+    assignments.do_assignments()
+    assert o.assignment is not None
+    assert (assignments.conflicts, assignments.retries) == (2, 2)
+    failures = assignments.consistency_retries
+    with pytest.raises(KvConsistency):
+        assignments._assign(o.key, o)
+    assert assignments.conflicts == 2+assignments.consistency_retries
+    contention = assignments.store.stats()['contention']['test_domain']
+    assert contention == dict(
+        conflicts=2+assignments.consistency_retries,
+        retries=2+assignments.consistency_retries-1)
+
+
 class layout(CarthageLayout):
     class config(NetworkConfigModel):
         add('eth0', mac=None, net=injector_access('pool_network'),
@@ -201,3 +499,31 @@ async def test_network_pool(ainjector):
     kvstore = ainjector.get_instance(KvStore)
     l.pool_network.assign_addresses()
     
+
+@async_test
+async def test_plan_writes_no_assignments(ainjector, capsys):
+    from carthage.runner_commands import PlanCommand
+    class PlanMachine(Machine, SetupTaskMixin):
+        @property
+        def stamp_path(self): return self.model.stamp_path
+
+        @setup_task("configure")
+        def configure(self): pass
+
+    class plan_layout(layout):
+        async def resolve_networking(self, force=False):
+            # In real layouts, resolving networking can write
+            # assignments through resolved event listeners.
+            assert False, 'plan must not resolve networking'
+
+        class c(MachineModel):
+            add_provider(machine_implementation_key, dependency_quote(PlanMachine))
+    ainjector.add_provider(InjectionKey(CarthageLayout), plan_layout)
+    kvstore = ainjector.get_instance(KvStore)
+    before = kvstore.stats()['domains']
+    command = await ainjector(PlanCommand)
+    await command.run(argparse.Namespace(json=True))
+    assert kvstore.stats()['domains'] == before
+    plan = json.loads(capsys.readouterr().out)
+    assert plan['errors'] == []
+    assert [t['object'] for t in plan['tasks']] == ['c']
@@ -139,6 +139,213 @@ async def test_failure_forces_rerun(ainjector):
     assert called == 3
 
 
+@async_test
+async def test_kvstore_stamps(ainjector):
+    called = []
+
+    class c(Stampable):
+        @setup_task("first")
+        def first(self):
+            called.append('first')
+
+        @setup_task("second")
+        def second(self):
+            called.append('second')
+
+    await ainjector(c)
+    assert called == ['first', 'second']
+    assert c.stamp_path.joinpath('.stamp-first').exists()
+    config = ainjector.injector(carthage.ConfigLayout)
+    config.tasks.stamp_backend = 'kvstore'
+    ainjector.add_provider(carthage.KvStore)
+    ainjector.add_provider(KvStamps)
+    # The existing stamp files are imported
+    o = await ainjector(c)
+    assert called == ['first', 'second']
+    assert o.check_stamp('first')[0] == c.stamp_path.joinpath('.stamp-first').stat().st_mtime
+    o.delete_stamp('second')
+    await ainjector(c)
+    assert called == ['first', 'second', 'second']
+    # Stamps are no longer written to files
+    os.unlink(c.stamp_path/'.stamp-second')
+    await ainjector(c)
+    assert called == ['first', 'second', 'second']
+    # Removing the stamp directory discards the stamps
+    shutil.rmtree(c.stamp_path)
+    assert not o.check_stamp('first')[0]
+    await ainjector(c)
+    assert called == ['first', 'second', 'second', 'first', 'second']
+    assert not c.stamp_path.joinpath('.stamp-first').exists()
+
+
+@async_test
+async def test_task_graph(ainjector):
+    running = set()
+    max_running = 0
+    called = []
+
+    async def work(name):
+        nonlocal max_running
+        running.add(name)
+        max_running = max(max_running, len(running))
+        await asyncio.sleep(0.02)
+        running.remove(name)
+        called.append(name)
+
+    class c(Stampable):
+        @setup_task("base", requires=())
+        async def base(self): await work('base')
+
+        @setup_task("render", requires=())
+        async def render(self): await work('render')
+
+        @setup_task("keys", requires=())
+        async def keys(self): await work('keys')
+
+        @setup_task("uses base", requires=base)
+        async def uses_base(self):
+            assert 'base' in called
+            await work('uses_base')
+
+        @setup_task("everything")
+        async def everything(self):
+            assert not running
+            await work('everything')
+
+    config = ainjector.injector(carthage.ConfigLayout)
+    config.tasks.concurrency = 2
+    await ainjector(c)
+    assert max_running == 2
+    assert called[-1] == 'everything'
+    # Rerunning render invalidates only the tasks that depend on it
+    called.clear()
+    c.delete_stamp(c, 'render')
+    await ainjector(c)
+    assert called == ['render', 'everything']
+
+
+@async_test
+async def test_setup_task_memo(ainjector):
+    hashed = 0
+
+    class server(Stampable):
+        @setup_task("update files")
+        def update_files(self): pass
+
+        @update_files.hash()
+        def update_files(self):
+            nonlocal hashed
+            hashed += 1
+            return "files"
+
+    class client(Stampable):
+        server_dependency = cross_object_dependency(server.update_files, 'server')
+
+        def __init__(self, server, **kwargs):
+            self.server = server
+            super().__init__(**kwargs)
+
+    s = await ainjector(server)
+    hashed = 0
+    with setup_task_memo() as memo:
+        clients = [await ainjector(client, server=s) for i in range(10)]
+        assert hashed == 1
+        assert memo.hits >= 9
+        # Running the task discards what the memo knows about it
+        s.update_files()
+        assert hashed == 2
+        await ainjector(client, server=s)
+        assert hashed == 3
+        # A task spawned during the run may outlive it
+        proceed = asyncio.Event()
+        async def long_lived():
+            await proceed.wait()
+            await ainjector(client, server=s)
+        spawned = asyncio.ensure_future(long_lived())
+    assert not memo.active
+    proceed.set()
+    await spawned
+    assert hashed == 4
+
+
+@async_test
+async def test_plan_setup_tasks(ainjector):
+    from carthage.task_history import task_history
+    called = 0
+    fake_hash = "1"
+
+    class c(Stampable):
+        @setup_task("first")
+        def first(self):
+            nonlocal called
+            called += 1
+
+        @first.hash()
+        def first(self): return fake_hash
+
+        @setup_task("second")
+        def second(self):
+            nonlocal called
+            called += 1
+
+    o = await ainjector(c)
+    assert called == 2
+    history = task_history(ainjector.injector(carthage.ConfigLayout))
+    assert history.predict(c.first) is not None
+    plan = await plan_setup_tasks([o, object()])
+    assert plan.objects_checked == 1
+    assert plan.tasks == []
+    fake_hash = "2"
+    plan = await plan_setup_tasks([o], history=history)
+    assert [(t.task.stamp, t.reason) for t in plan.tasks] == [
+        ('first', 'hash changed'), ('second', 'dependency newer')]
+    assert plan.unpredicted == 0
+    assert plan.predicted_total == history.predict(c.first)+history.predict(c.second)
+    o.delete_stamp('second')
+    plan = await plan_setup_tasks([o])
+    assert plan.tasks[1].reason == 'no stamp'
+    assert called == 2
+
+
+def test_task_history_stats(tmp_path, monkeypatch):
+    import carthage.task_history
+    from carthage.task_history import TaskHistory
+
+    class task:
+        stamp = 'slow'
+
+    class obj:
+        name = 'obj'
+    history = TaskHistory(tmp_path/'history.jsonl', max_records=5)
+    monkeypatch.setattr(carthage.task_history, 'run_id', 'first')
+    for i in range(4):
+        history.record(obj, task, 0, 1, 'success')
+    monkeypatch.setattr(carthage.task_history, 'run_id', 'second')
+    history.record(obj, task, 0, 2, 'success')
+    history.record(obj, task, 0, 3, 'failure')
+    assert history.runs() == ['first', 'second']
+    assert history.task_stats()['slow'] == dict(runs=6, failures=1, p50=1, p95=2, total=6)
+    assert history.slowest_objects() == [('obj', 9)]
+    assert history.regressions() == [('slow', 1, 2)]
+    # A fresh reader sees the same records
+    assert len(TaskHistory(history.path).records) == 6
+    for i in range(5):
+        history.record(obj, task, 0, 1, 'success')
+    # Rotated once more than twice max_records are held
+    assert len(history.records) == 5
+    assert len(TaskHistory(history.path).records) == 5
+    # Interleaved writers count each other's records without rereading
+    other = TaskHistory(history.path, max_records=5)
+    for i in range(2):
+        other.record(obj, task, 0, 1, 'success')
+        history.record(obj, task, 0, 1, 'success')
+    assert history._records is None and other._records is None
+    assert len(TaskHistory(history.path).records) == 9
+    other.record(obj, task, 0, 1, 'success')
+    history.record(obj, task, 0, 1, 'success')
+    assert len(TaskHistory(history.path).records) == 5
+
+
 @async_test
 async def test_order_override(ainjector):
     two_called = False
@@ -234,6 +441,150 @@ async def test_mako_hash(ainjector):
     assert output() == "bar"
 
 
+@async_test
+async def test_mako_render_once(ainjector):
+    rendered = 0
+    value = "foo"
+
+    def get_value():
+        nonlocal rendered
+        rendered += 1
+        return value
+
+    class c(Stampable):
+
+        mt = mako_task("render_count.mako", value=InjectionKey("value"))
+
+    ainjector.add_provider(InjectionKey("value"), get_value, allow_multiple=True)
+    o = await ainjector(c)
+    assert rendered == 1
+    await o.run_setup_tasks()
+    assert rendered == 2
+    # The render that detects the change is the one written
+    value = "bar"
+    await o.run_setup_tasks()
+    assert rendered == 3
+    assert o.stamp_path.joinpath("render_count").read_text() == "The value is bar.\n"
+    await o.run_setup_tasks()
+    assert rendered == 4
+    assert state_dir.joinpath("mako_modules").is_dir()
+    # Within a longer run, a render from an earlier check is not
+    # written once the inputs have changed
+    with setup_task_memo():
+        value = "baz"
+        assert (await c.mt.should_run_task(o, ainjector=ainjector))[0]
+        value = "quux"
+        await o.run_setup_tasks()
+    assert o.stamp_path.joinpath("render_count").read_text() == "The value is quux.\n"
+
+
+@async_test
+async def test_install_mako_incremental(ainjector, monkeypatch):
+    import contextlib
+    value = "foo"
+    copied = []
+    real_copy2 = shutil.copy2
+
+    def copy2(src, dest):
+        copied.append(Path(dest).name)
+        return real_copy2(src, dest)
+    monkeypatch.setattr(shutil, 'copy2', copy2)
+
+    class model(Stampable):
+        changing = mako_task("render_count.mako", value=InjectionKey("value"))
+        fixed = mako_task("test.mako")
+
+    class machine(Stampable):
+        install_mako = install_mako_task('model')
+
+        def __init__(self, model, **kwargs):
+            self.model = model
+            super().__init__(**kwargs)
+
+        @contextlib.asynccontextmanager
+        async def filesystem_access(self):
+            yield state_dir/'root'
+
+    ainjector.add_provider(InjectionKey("value"), lambda: value, allow_multiple=True)
+    m = await ainjector(model)
+    await ainjector(machine, model=m)
+    assert sorted(copied) == ['render_count', 'test']
+    value = "bar"
+    copied.clear()
+    await m.run_setup_tasks()
+    await ainjector(machine, model=m)
+    assert copied == ['render_count']
+    assert state_dir.joinpath('root/render_count').read_text() == "The value is bar.\n"
+    # Without a stamp everything is installed again
+    machine.delete_stamp(machine, 'install_mako')
+    copied.clear()
+    await ainjector(machine, model=m)
+    assert sorted(copied) == ['render_count', 'test']
+
+
+@async_test
+async def test_install_mako_remote(ainjector, monkeypatch):
+    import contextlib
+    from carthage.machine import Machine
+    from carthage.local import LocalMachineMixin
+    value = "foo"
+    rsyncs = []
+
+    class model(Stampable):
+        changing = mako_task("render_count.mako", value=InjectionKey("value"))
+        fixed = mako_task("test.mako")
+
+    class remote(Machine, Stampable):
+        install_mako = install_mako_task('model')
+
+        def __init__(self, model, **kwargs):
+            self.model = model
+            super().__init__(name='remote', **kwargs)
+
+        @contextlib.asynccontextmanager
+        async def machine_running(self, **kwargs):
+            yield self
+
+        @contextlib.asynccontextmanager
+        async def filesystem_access(self):
+            assert False, 'remote machines are installed with rsync'
+            yield
+
+        def rsync_path(self, p):
+            return ('remote', p)
+
+        async def rsync(self, *args):
+            files_from = args[args.index('--files-from')+1]
+            rsyncs.append((sorted(Path(files_from).read_text().split()), args[-2:]))
+
+    class local(LocalMachineMixin, Machine, Stampable):
+        install_mako = install_mako_task('model')
+
+        def __init__(self, model, **kwargs):
+            self.model = model
+            super().__init__(name='local', **kwargs)
+
+        @contextlib.asynccontextmanager
+        async def filesystem_access(self):
+            yield state_dir/'local_root'
+
+        async def rsync(self, *args):
+            assert False, 'local machines are installed through filesystem_access'
+
+    ainjector.add_provider(InjectionKey("value"), lambda: value, allow_multiple=True)
+    m = await ainjector(model)
+    await ainjector(remote, model=m)
+    assert rsyncs == [(['render_count', 'test'], (str(m.stamp_path)+'/', ('remote', '/')))]
+    value = "bar"
+    rsyncs.clear()
+    await m.run_setup_tasks()
+    await ainjector(remote, model=m)
+    assert [files for files, _ in rsyncs] == [['render_count']]
+    # LocalMachineMixin does not use filesystem_access for rsync but is local
+    await ainjector(local, model=m)
+    assert state_dir.joinpath('local_root/render_count').read_text() == "The value is bar.\n"
+
+
 @async_test
 async def test_setup_task_context(ainjector):
     class ContextTest(Stampable):
@@ -280,6 +631,36 @@ async def test_add_setup_task(ainjector):
     assert task_b_called
 
 
+@async_test
+async def test_add_setup_task_requires(ainjector):
+    called = []
+
+    class C(Stampable):
+        @setup_task("first", requires=())
+        async def first(self):
+            await asyncio.sleep(0.01)
+            called.append('first')
+
+        @setup_task("independent", requires=())
+        async def independent(self): called.append('independent')
+
+    async def after_first(self):
+        called.append('after_first')
+    config = ainjector.injector(carthage.ConfigLayout)
+    config.tasks.concurrency = 2
+    o = await ainjector(C)
+    called.clear()
+    for t in o.setup_tasks: o.delete_stamp(t.stamp)
+    o.add_setup_task(after_first, description="after first", requires=C.first)
+    added = o.setup_tasks[-1]
+    assert added.requires == (C.first,)
+    assert added.order > C.first.order
+    await o.run_setup_tasks()
+    assert called.index('after_first') > called.index('first')
+    with pytest.raises(TypeError):
+        o.add_setup_task(after_first, description="too early", requires=[C.first], order=C.first.order)
+
+
 @async_test
 async def test_setup_task_introspection(ainjector):
     class Dependent(Stampable):